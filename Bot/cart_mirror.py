@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import time
+
+import db_aps
+
+
+cart_logger = logging.getLogger('cart_logger')
+
+CART_MIRROR_TTL = int(os.getenv('CART_MIRROR_TTL', 24 * 60 * 60))
+RECONCILE_INTERVAL = int(os.getenv('CART_RECONCILE_INTERVAL', 60))
+NO_MIRROR_SYNCED_AT = -1
+
+SAVE_IF_UNCHANGED_SCRIPT = '''
+local mirror = redis.call('get', KEYS[1])
+local synced_at = mirror and cjson.decode(mirror)['synced_at'] or -1
+if synced_at ~= tonumber(ARGV[1]) then
+    return mirror
+end
+redis.call('set', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return false
+'''
+
+
+def get_cart_mirror(cart_name):
+    db = db_aps.get_database_connection()
+    mirror = db.get(f'cart:{cart_name}')
+    if mirror is None:
+        return None
+    return json.loads(mirror)
+
+
+async def async_get_cart_mirror(cart_name):
+    db = await db_aps.get_async_database_connection()
+    mirror = await db.get(f'cart:{cart_name}')
+    if mirror is None:
+        return None
+    return json.loads(mirror)
+
+
+def collect_cart_mirror(cart_items_response):
+    '''
+    Moltin carts/{cart_name}/items responses, as well as item add/remove
+    responses, hold cart items in `data` and cart totals in `meta`.
+    '''
+    return {
+        'items': cart_items_response['data'],
+        'meta': cart_items_response['meta'],
+        'synced_at': time.time(),
+    }
+
+
+def save_cart_mirror(cart_name, cart_items_response):
+    mirror = collect_cart_mirror(cart_items_response)
+    db = db_aps.get_database_connection()
+    db.set(f'cart:{cart_name}', json.dumps(mirror), ex=CART_MIRROR_TTL)
+    cart_logger.debug(f'Cart «{cart_name}» mirror was saved')
+    return mirror
+
+
+async def async_save_cart_mirror(cart_name, cart_items_response):
+    mirror = collect_cart_mirror(cart_items_response)
+    db = await db_aps.get_async_database_connection()
+    await db.set(f'cart:{cart_name}', json.dumps(mirror), expire=CART_MIRROR_TTL)
+    cart_logger.debug(f'Cart «{cart_name}» mirror was saved')
+    return mirror
+
+
+def save_cart_mirror_if_unchanged(cart_name, cart_items_response, synced_at=None):
+    '''
+    Save fetched cart unless mirror changed since `synced_at` (None if there was no mirror),
+    so a slow fetch does not overwrite a newer add/remove response. Returns the mirror which is saved now.
+    '''
+    mirror = collect_cart_mirror(cart_items_response)
+    db = db_aps.get_database_connection()
+    newer_mirror = db.eval(SAVE_IF_UNCHANGED_SCRIPT, 1, f'cart:{cart_name}',
+                           collect_expected_synced_at(synced_at), json.dumps(mirror), CART_MIRROR_TTL)
+    if newer_mirror:
+        cart_logger.debug(f'Cart «{cart_name}» mirror changed while it was fetched, fetched cart is dropped')
+        return json.loads(newer_mirror)
+    cart_logger.debug(f'Cart «{cart_name}» mirror was saved')
+    return mirror
+
+
+async def async_save_cart_mirror_if_unchanged(cart_name, cart_items_response, synced_at=None):
+    mirror = collect_cart_mirror(cart_items_response)
+    db = await db_aps.get_async_database_connection()
+    newer_mirror = await db.eval(
+        SAVE_IF_UNCHANGED_SCRIPT, keys=[f'cart:{cart_name}'],
+        args=[collect_expected_synced_at(synced_at), json.dumps(mirror), CART_MIRROR_TTL],
+    )
+    if newer_mirror:
+        cart_logger.debug(f'Cart «{cart_name}» mirror changed while it was fetched, fetched cart is dropped')
+        return json.loads(newer_mirror)
+    cart_logger.debug(f'Cart «{cart_name}» mirror was saved')
+    return mirror
+
+
+def collect_expected_synced_at(synced_at):
+    return str(NO_MIRROR_SYNCED_AT if synced_at is None else synced_at)
+
+
+def delete_cart_mirror(cart_name):
+    db = db_aps.get_database_connection()
+    db.delete(f'cart:{cart_name}')
+
+
+async def async_delete_cart_mirror(cart_name):
+    db = await db_aps.get_async_database_connection()
+    await db.delete(f'cart:{cart_name}')
+
+
+def collect_cart(cart_name, mirror):
+    return {
+        'id': cart_name,
+        'type': 'cart',
+        'meta': mirror['meta'],
+    }
+
+
+def check_mirror_needs_reconcile(cart_name, mirror):
+    '''
+    True for one caller at a time when mirror is older than RECONCILE_INTERVAL.
+    '''
+    if time.time() - mirror['synced_at'] < RECONCILE_INTERVAL:
+        return False
+    db = db_aps.get_database_connection()
+    return bool(db.set(f'cart:{cart_name}:reconciling', 1, nx=True, ex=RECONCILE_INTERVAL))
+
+
+async def async_check_mirror_needs_reconcile(cart_name, mirror):
+    if time.time() - mirror['synced_at'] < RECONCILE_INTERVAL:
+        return False
+    db = await db_aps.get_async_database_connection()
+    return await db.set(f'cart:{cart_name}:reconciling', 1, expire=RECONCILE_INTERVAL, exist=db.SET_IF_NOT_EXIST)
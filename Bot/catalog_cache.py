@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import os
+import time
+
+import db_aps
+import image_cache
+import moltin_aioaps
+import moltin_aiorequests
+
+
+cache_logger = logging.getLogger('cache_logger')
+
+CATALOG_TTL = int(os.getenv('CATALOG_CACHE_TTL', 600))
+VERSION_CHECK_INTERVAL = int(os.getenv('CATALOG_VERSION_CHECK_INTERVAL', 5))
+CATALOG_VERSION_KEY = 'catalog_version'
+
+_catalog = {
+    'version': None,
+    'expires': 0,
+    'products': [],
+    'products_by_id': {},
+    'categories': [],
+}
+_current_version = {
+    'version': None,
+    'checked': 0,
+}
+_refresh_lock = None
+
+
+def get_catalog_version():
+    db = db_aps.get_database_connection()
+    version = db.get(CATALOG_VERSION_KEY)
+    return int(version) if version else 0
+
+
+async def async_get_catalog_version():
+    db = await db_aps.get_async_database_connection()
+    version = await db.get(CATALOG_VERSION_KEY)
+    return int(version) if version else 0
+
+
+def invalidate_catalog():
+    '''
+    Called on moltin catalog webhooks. Every process holding the catalog
+    in memory refetches it on the next version check.
+    '''
+    db = db_aps.get_database_connection()
+    version = db.incr(CATALOG_VERSION_KEY)
+    note_catalog_version(version)
+    cache_logger.debug(f'Catalog version bumped to {version}')
+    return version
+
+
+def get_current_catalog_version():
+    now = time.monotonic()
+    if now - _current_version['checked'] >= VERSION_CHECK_INTERVAL:
+        note_catalog_version(get_catalog_version())
+    return _current_version['version']
+
+
+async def async_get_current_catalog_version():
+    now = time.monotonic()
+    if now - _current_version['checked'] >= VERSION_CHECK_INTERVAL:
+        note_catalog_version(await async_get_catalog_version())
+    return _current_version['version']
+
+
+def note_catalog_version(version):
+    '''
+    Save catalog version read from db, e.g. in the same pipeline with user state.
+    '''
+    _current_version.update({
+        'version': version,
+        'checked': time.monotonic(),
+    })
+
+
+def check_catalog_is_fresh(version):
+    if time.monotonic() >= _catalog['expires']:
+        return False
+    return _catalog['version'] == version
+
+
+async def refresh_catalog():
+    global _refresh_lock
+    if _refresh_lock is None:
+        _refresh_lock = asyncio.Lock()
+    async with _refresh_lock:
+        version = await async_get_current_catalog_version()
+        if check_catalog_is_fresh(version):
+            return
+        products, categories = await asyncio.gather(
+            fetch_products(),
+            moltin_aioaps.get_all_categories(),
+        )
+        _catalog.update({
+            'version': version,
+            'expires': time.monotonic() + CATALOG_TTL,
+            'products': products,
+            'products_by_id': {product['id']: product for product in products},
+            'categories': categories,
+        })
+        cache_logger.debug(f'Catalog version {version} was cached')
+
+
+async def fetch_products():
+    products = []
+    payload = {'include': 'main_images'}
+    async for page in moltin_aiorequests.iterate_pages('products', payload):
+        products.extend(page['data'])
+        await image_cache.async_save_image_urls(image_cache.collect_included_image_urls(page))
+    return products
+
+
+def get_loaded_catalog_version():
+    return _catalog['version']
+
+
+async def get_all_products():
+    if not check_catalog_is_fresh(await async_get_current_catalog_version()):
+        await refresh_catalog()
+    return _catalog['products']
+
+
+async def get_all_categories():
+    if not check_catalog_is_fresh(await async_get_current_catalog_version()):
+        await refresh_catalog()
+    return _catalog['categories']
+
+
+async def get_product_info(product_id):
+    if not check_catalog_is_fresh(await async_get_current_catalog_version()):
+        await refresh_catalog()
+    product_info = _catalog['products_by_id'].get(product_id)
+    if product_info is None:
+        product_info = await moltin_aioaps.get_product_info(product_id)
+    return product_info
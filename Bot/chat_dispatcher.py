@@ -0,0 +1,109 @@
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+import os
+
+from aiogram import types
+
+import db_aps
+
+
+dispatcher_logger = logging.getLogger('dispatcher_logger')
+
+MAX_ACTIVE_CHATS = int(os.getenv('TG_MAX_ACTIVE_CHATS', 100))
+CHAT_LOCK_TIMEOUT = int(os.getenv('TG_CHAT_LOCK_TIMEOUT', 60))
+LAST_CALLBACK_TTL = 24 * 60 * 60
+
+CHECK_CALLBACK_SCRIPT = '''
+local last_message_id = tonumber(redis.call('get', KEYS[1]))
+if last_message_id and tonumber(ARGV[1]) < last_message_id then
+    return 1
+end
+redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 0
+'''
+
+_chat_queues = {}
+_active_chats = None
+
+
+async def dispatch(chat_id, update, handler):
+    '''
+    Updates of one chat are handled strictly one after another,
+    updates of different chats are handled concurrently, at most MAX_ACTIVE_CHATS at once.
+    '''
+    queue = _chat_queues.get(chat_id)
+    if queue is None:
+        queue = _chat_queues[chat_id] = asyncio.Queue()
+        asyncio.ensure_future(process_chat_updates(chat_id, queue, handler))
+    queue.put_nowait(update)
+
+
+async def process_chat_updates(chat_id, queue, handler):
+    global _active_chats
+    if _active_chats is None:
+        _active_chats = asyncio.Semaphore(MAX_ACTIVE_CHATS)
+    try:
+        # updates may come while the lock is being released, so check the queue once more after it
+        while not queue.empty():
+            async with _active_chats, lock_chat(chat_id):
+                while not queue.empty():
+                    await handle_chat_update(chat_id, queue.get_nowait(), handler)
+    finally:
+        del _chat_queues[chat_id]
+
+
+async def handle_chat_update(chat_id, update, handler):
+    if await check_update_is_stale(chat_id, update):
+        await update.answer()
+        dispatcher_logger.debug(f'Stale callback from «{chat_id}» was dropped')
+        return
+    try:
+        await handler(update)
+    except Exception:
+        dispatcher_logger.exception(f'Update from «{chat_id}» handling failed')
+
+
+async def check_update_is_stale(chat_id, update):
+    '''
+    Callback is stale if it came from a message older than the message
+    of a callback which was already handled. The last message id is kept in db
+    next to the chat lock, so the check is the same in every process.
+    '''
+    if type(update) != types.CallbackQuery:
+        return False
+    db = await db_aps.get_async_database_connection()
+    is_stale = await db.eval(
+        CHECK_CALLBACK_SCRIPT, keys=[f'chat_lock:{chat_id}:last_callback'],
+        args=[update.message.message_id, LAST_CALLBACK_TTL],
+    )
+    return bool(is_stale)
+
+
+@asynccontextmanager
+async def lock_chat(chat_id):
+    '''
+    Db lock keeps chat updates ordered when the bot runs in several processes.
+    The lock is extended while updates are handled, however long they take.
+    '''
+    lock_key = f'chat_lock:{chat_id}'
+    token = await db_aps.async_acquire_lock(lock_key, CHAT_LOCK_TIMEOUT)
+    renewal = asyncio.ensure_future(keep_chat_lock(lock_key, token))
+    try:
+        yield
+    finally:
+        renewal.cancel()
+        await db_aps.async_release_lock(lock_key, token)
+
+
+async def keep_chat_lock(lock_key, token):
+    while True:
+        await asyncio.sleep(CHAT_LOCK_TIMEOUT / 3)
+        try:
+            is_renewed = await db_aps.async_renew_lock(lock_key, token, CHAT_LOCK_TIMEOUT)
+        except Exception:
+            dispatcher_logger.exception(f'{lock_key} renewal failed')
+            continue
+        if not is_renewed:
+            dispatcher_logger.error(f'{lock_key} was lost while updates were handled')
+            return
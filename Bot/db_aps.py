@@ -1,16 +1,38 @@
+import asyncio
 import logging
 import os
+import time
+import uuid
 
+import aioredis
 from dotenv import load_dotenv
 import redis
 
+import moltin_aioaps
 import moltin_aps
 
 
 _database = None
+_async_database = None
+_async_database_lock = None
 
 db_logger = logging.getLogger('db_logger')
 
+LOCK_RETRY_DELAY = 0.05
+
+RENEW_LOCK_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+'''
+RELEASE_LOCK_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
 load_dotenv()
 
 
@@ -25,6 +47,79 @@ def get_database_connection():
     return _database
 
 
+async def get_async_database_connection():
+    global _async_database, _async_database_lock
+    if _async_database_lock is None:
+        _async_database_lock = asyncio.Lock()
+    async with _async_database_lock:
+        if _async_database is None:
+            database_password = os.getenv('DB_PASSWORD')
+            database_host = os.getenv('DB_HOST')
+            database_port = os.getenv('DB_PORT')
+            pool_size = int(os.getenv('DB_POOL_SIZE', 10))
+            _async_database = await aioredis.create_redis_pool(
+                (database_host, int(database_port)), password=database_password, maxsize=pool_size,
+            )
+            db_logger.debug('Got new async db connection pool')
+    return _async_database
+
+
+async def close_async_database_connection():
+    global _async_database
+    if _async_database is not None:
+        _async_database.close()
+        await _async_database.wait_closed()
+        _async_database = None
+
+
+def acquire_lock(lock_key, timeout, blocking=True):
+    '''
+    Db lock which expires after `timeout` seconds unless it is renewed. Returns token
+    of the lock, which is needed to renew and release it, or None if the lock is held
+    by someone else and `blocking` is False.
+    '''
+    db = get_database_connection()
+    token = uuid.uuid4().hex
+    while not db.set(lock_key, token, nx=True, px=int(timeout * 1000)):
+        if not blocking:
+            return None
+        time.sleep(LOCK_RETRY_DELAY)
+    return token
+
+
+def renew_lock(lock_key, token, timeout):
+    '''
+    False if the lock expired and may be held by someone else now.
+    '''
+    db = get_database_connection()
+    return bool(db.eval(RENEW_LOCK_SCRIPT, 1, lock_key, token, int(timeout * 1000)))
+
+
+def release_lock(lock_key, token):
+    db = get_database_connection()
+    db.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+
+
+async def async_acquire_lock(lock_key, timeout, blocking=True):
+    db = await get_async_database_connection()
+    token = uuid.uuid4().hex
+    while not await db.set(lock_key, token, pexpire=int(timeout * 1000), exist=db.SET_IF_NOT_EXIST):
+        if not blocking:
+            return None
+        await asyncio.sleep(LOCK_RETRY_DELAY)
+    return token
+
+
+async def async_renew_lock(lock_key, token, timeout):
+    db = await get_async_database_connection()
+    return bool(await db.eval(RENEW_LOCK_SCRIPT, keys=[lock_key], args=[token, int(timeout * 1000)]))
+
+
+async def async_release_lock(lock_key, token):
+    db = await get_async_database_connection()
+    await db.eval(RELEASE_LOCK_SCRIPT, keys=[lock_key], args=[token])
+
+
 def get_moltin_customer_id(customer_key):
     db = get_database_connection()
     customer_id = db.get(customer_key)
@@ -46,3 +141,26 @@ def create_customer(customer_key, customer_info):
     customer_id = moltin_aps.create_customer(customer_info)['data']['id']
     db.set(customer_key, customer_id)
     db_logger.debug(f'New customer «{customer_key}» was created')
+
+
+async def async_get_moltin_customer_id(customer_key):
+    db = await get_async_database_connection()
+    customer_id = await db.get(customer_key)
+    if customer_id:
+        customer_id = customer_id.decode('utf-8')
+    db_logger.debug(f'Got moltin customer id «{customer_id}» from db')
+    return customer_id
+
+
+async def async_update_customer_info(customer_key, customer_info):
+    db = await get_async_database_connection()
+    customer_id = (await db.get(customer_key)).decode('utf-8')
+    await moltin_aioaps.update_customer_info(customer_id, customer_info)
+    db_logger.debug(f'Customer «{customer_id}» info was updated')
+
+
+async def async_create_customer(customer_key, customer_info):
+    db = await get_async_database_connection()
+    customer_id = (await moltin_aioaps.create_customer(customer_info))['data']['id']
+    await db.set(customer_key, customer_id)
+    db_logger.debug(f'New customer «{customer_key}» was created')
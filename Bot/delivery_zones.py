@@ -0,0 +1,248 @@
+import logging
+import math
+import os
+import time
+import uuid
+
+from dotenv import load_dotenv
+from geopy.distance import distance
+import numpy as np
+
+import db_aps
+import pizzeria_index
+import scheduled_jobs
+
+
+zones_logger = logging.getLogger('zones_logger')
+
+# (max distance to pizzeria in km, delivery price)
+DELIVERY_TIERS = [
+    (0.5, 0),
+    (5, 100),
+    (20, 300),
+]
+CELL_SIZE = float(os.getenv('DELIVERY_ZONE_CELL_SIZE', 0.005))
+KM_IN_DEGREE = 111.2
+
+ZONES_KEY = 'delivery_zones'
+ZONES_VERSION_KEY = 'delivery_zones:version'
+REBUILD_LOCK_KEY = 'delivery_zones:rebuild_lock'
+REBUILD_LOCK_TIMEOUT = int(os.getenv('DELIVERY_ZONES_REBUILD_LOCK_TIMEOUT', 600))
+REBUILD_DELAY = float(os.getenv('DELIVERY_ZONES_REBUILD_DELAY', 5))
+REBUILD_JOB = 'delivery_zones_rebuild'
+
+LOAD_ZONES_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('hgetall', KEYS[2])
+end
+return false
+'''
+REPLACE_ZONES_SCRIPT = '''
+local saved_version = tonumber(redis.call('get', KEYS[1]))
+if saved_version and saved_version >= tonumber(ARGV[1]) then
+    redis.call('del', KEYS[3])
+    return 0
+end
+if redis.call('exists', KEYS[3]) == 1 then
+    redis.call('rename', KEYS[3], KEYS[2])
+else
+    redis.call('del', KEYS[2])
+end
+redis.call('set', KEYS[1], ARGV[1])
+return 1
+'''
+
+_zone_map = {
+    'version': None,
+    'checked': 0,
+    'zones': {},
+}
+
+
+def get_delivery_tier(pizzeria_distance):
+    '''
+    Index of the tier in DELIVERY_TIERS or None if delivery is not allowed.
+    '''
+    for tier, (max_distance, delivery_price) in enumerate(DELIVERY_TIERS):
+        if pizzeria_distance <= max_distance:
+            return tier
+    return None
+
+
+def get_cell(coords):
+    lat, lon = coords
+    return math.floor(lat / CELL_SIZE), math.floor(lon / CELL_SIZE)
+
+
+def find_serving_pizzeria(coords, index):
+    return find_pizzeria_in_zones(coords, index, get_zone_map(index.version))
+
+
+async def async_find_serving_pizzeria(coords, index):
+    return find_pizzeria_in_zones(coords, index, await async_get_zone_map(index.version))
+
+
+def find_pizzeria_in_zones(coords, index, zones):
+    '''
+    Serving pizzeria with exact `distance` and delivery tier.
+    Cells inside one zone are answered from the zone map, cells near zone
+    borders fall back to the full nearest pizzeria search.
+    '''
+    zone = zones.get('{}:{}'.format(*get_cell(coords)))
+    if zone is not None:
+        tier, pizzeria_id = zone.split(',', 1)
+        pizzeria = index.pizzerias_by_id.get(pizzeria_id)
+        if pizzeria is not None:
+            pizzeria_distance = distance(coords, (pizzeria['latitude'], pizzeria['longitude'])).kilometers
+            return dict(pizzeria, distance=pizzeria_distance), int(tier)
+    nearest_pizzeria = index.find_nearest(coords)
+    return nearest_pizzeria, get_delivery_tier(nearest_pizzeria['distance'])
+
+
+def get_zone_map(version):
+    zones = get_loaded_zone_map(version)
+    if zones is not None:
+        return zones
+    db = db_aps.get_database_connection()
+    zones = db.eval(LOAD_ZONES_SCRIPT, 2, ZONES_VERSION_KEY, ZONES_KEY, version)
+    return remember_zone_map(version, zones)
+
+
+async def async_get_zone_map(version):
+    zones = get_loaded_zone_map(version)
+    if zones is not None:
+        return zones
+    db = await db_aps.get_async_database_connection()
+    zones = await db.eval(LOAD_ZONES_SCRIPT, keys=[ZONES_VERSION_KEY, ZONES_KEY], args=[version])
+    return remember_zone_map(version, zones)
+
+
+def get_loaded_zone_map(version):
+    '''
+    Zone map from process memory, {} if db was checked less than VERSION_CHECK_INTERVAL ago
+    or None if it is time to load the map from db.
+    '''
+    if _zone_map['version'] == version:
+        return _zone_map['zones']
+    now = time.monotonic()
+    if now - _zone_map['checked'] < pizzeria_index.VERSION_CHECK_INTERVAL:
+        return {}
+    _zone_map['checked'] = now
+    return None
+
+
+def remember_zone_map(version, zones):
+    '''
+    Zones come as a flat list of cells and zones, or None if the map in db
+    is not built for this version: the hash is read only when versions match.
+    '''
+    if zones is None:
+        zones_logger.debug(f'Zone map is not built for pizzerias version {version}')
+        return {}
+    _zone_map.update({
+        'version': version,
+        'zones': {cell.decode('utf-8'): zone.decode('utf-8') for cell, zone in zip(zones[::2], zones[1::2])},
+    })
+    zones_logger.debug(f'Zone map version {version} was loaded')
+    return _zone_map['zones']
+
+
+def collect_candidate_cells(index):
+    max_distance = DELIVERY_TIERS[-1][0]
+    lat_margin = math.ceil(max_distance / KM_IN_DEGREE / CELL_SIZE) + 1
+    cells = set()
+    for pizzeria in index.pizzerias:
+        lat, lon = float(pizzeria['latitude']), float(pizzeria['longitude'])
+        lat_cos = max(math.cos(math.radians(abs(lat) + max_distance / KM_IN_DEGREE)), 0.01)
+        lon_margin = math.ceil(max_distance / (KM_IN_DEGREE * lat_cos) / CELL_SIZE) + 1
+        lat_cell, lon_cell = get_cell((lat, lon))
+        for i in range(lat_cell - lat_margin, lat_cell + lat_margin + 1):
+            cells.update((i, j) for j in range(lon_cell - lon_margin, lon_cell + lon_margin + 1))
+    return cells
+
+
+def build_zone_map(index):
+    '''
+    Map cell → "tier,pizzeria_id" for every cell where all points have the same
+    serving pizzeria and delivery tier. Bounds are conservative: haversine error
+    plus the cell half-diagonal on both sides of the distance from cell center.
+    '''
+    error = pizzeria_index.HAVERSINE_ERROR
+    zones = {}
+    if len(index) == 0:
+        return zones
+    for lat_cell, lon_cell in collect_candidate_cells(index):
+        center = ((lat_cell + 0.5) * CELL_SIZE, (lon_cell + 0.5) * CELL_SIZE)
+        widest_lat = min(abs(lat_cell), abs(lat_cell + 1)) * CELL_SIZE
+        cell_height = KM_IN_DEGREE * CELL_SIZE
+        cell_width = cell_height * math.cos(math.radians(widest_lat))
+        half_diagonal = math.hypot(cell_height, cell_width) / 2 * (1 + error)
+
+        haversine_distances = index.get_haversine_distances(center)
+        if len(index) > 1:
+            nearest, second = np.argpartition(haversine_distances, 1)[:2]
+            second_min_distance = haversine_distances[second] * (1 - error) - half_diagonal
+        else:
+            nearest = 0
+            second_min_distance = math.inf
+        min_distance = haversine_distances[nearest] * (1 - error) - half_diagonal
+        max_distance = haversine_distances[nearest] * (1 + error) + half_diagonal
+        if second_min_distance <= max_distance:
+            continue
+        tier = get_delivery_tier(max(min_distance, 0))
+        if tier is None or tier != get_delivery_tier(max_distance):
+            continue
+        zones[f'{lat_cell}:{lon_cell}'] = '{},{}'.format(tier, index.pizzerias[nearest]['id'])
+    return zones
+
+
+def save_zone_map(zones, version):
+    '''
+    Map is written to its own key and replaces the saved one only if the saved map
+    is built for an older pizzerias version, so a slow build never overwrites a newer map.
+    '''
+    db = db_aps.get_database_connection()
+    new_zones_key = f'{ZONES_KEY}:new:{version}:{uuid.uuid4().hex}'
+    pipeline = db.pipeline()
+    for cells in chunk_zones(zones):
+        pipeline.hmset(new_zones_key, cells)
+    # map left by a failed save is removed by db
+    pipeline.expire(new_zones_key, REBUILD_LOCK_TIMEOUT)
+    pipeline.execute()
+
+    is_saved = db.eval(REPLACE_ZONES_SCRIPT, 3, ZONES_VERSION_KEY, ZONES_KEY, new_zones_key, version)
+    if is_saved:
+        zones_logger.debug(f'Zone map version {version} with {len(zones)} cells was saved')
+    else:
+        zones_logger.debug(f'Zone map version {version} was dropped, newer one is saved')
+    return bool(is_saved)
+
+
+def chunk_zones(zones, chunk_size=10000):
+    cells = list(zones.items())
+    for start in range(0, len(cells), chunk_size):
+        yield dict(cells[start:start + chunk_size])
+
+
+def rebuild_zone_map():
+    lock_token = db_aps.acquire_lock(REBUILD_LOCK_KEY, REBUILD_LOCK_TIMEOUT)
+    try:
+        # the version noted in this process may be behind the one bumped by the event
+        pizzeria_index.note_pizzerias_version(pizzeria_index.get_pizzerias_version())
+        index = pizzeria_index.get_index()
+        save_zone_map(build_zone_map(index), index.version)
+    finally:
+        db_aps.release_lock(REBUILD_LOCK_KEY, lock_token)
+
+
+def schedule_zone_map_rebuild():
+    '''
+    Zone map is rebuilt by fb_worker REBUILD_DELAY after the first pizzerias change,
+    so a burst of changes costs a single rebuild.
+    '''
+    scheduled_jobs.schedule_job(REBUILD_JOB, REBUILD_DELAY)
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    rebuild_zone_map()
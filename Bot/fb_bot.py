@@ -1,13 +1,19 @@
+import json
 import os
 
 from dotenv import load_dotenv
 from flask import Flask, request
-import requests
 
+import catalog_cache
 import db_aps
+import delivery_zones
 import fb_cache
+import fb_events
 import fb_templates
+import http_sessions
+import image_cache
 import moltin_aps
+import pizzeria_index
 
 
 app = Flask(__name__)
@@ -36,27 +42,53 @@ def webhook():
     Основной вебхук, на который будут приходить сообщения от Facebook и Moltin.
     '''
     if request.headers['User-Agent'] == 'moltin/integrations':
-        # webhook on moltin products and categories create/update/delete events
-        # TODO handle updates and choose cache action
+        # webhook on moltin products, categories, files and flow entries create/update/delete events
         if request.headers['X-Moltin-Secret-Key'] != os.environ['VERIFY_TOKEN']:
             return 'Verification token mismatch', 403
-        fb_cache.update_cached_cards()
+        triggered_by, resource = parse_moltin_event(request.get_json())
+        handle_moltin_event(triggered_by, resource)
         return 'ok', 200
 
+    # messaging events are handled by fb_worker, so Facebook gets response at once
     data = request.get_json()
     for entry in data['entry']:
         for messaging_event in entry['messaging']:
-            postback = None
-            sender_id = messaging_event['sender']['id']
-            if messaging_event.get('message'):
-                message_text = messaging_event['message']['text']
-            if messaging_event.get('postback'):
-                message_text = messaging_event['postback']['title']
-                postback = messaging_event['postback']['payload']
-            handle_users_reply(sender_id, message_text, postback)
+            fb_events.enqueue_messaging_event(messaging_event)
     return 'ok', 200
 
 
+def parse_moltin_event(event):
+    resources = event['resources']
+    if isinstance(resources, str):
+        resources = json.loads(resources)
+    return event['triggered_by'], resources['data']
+
+
+def handle_moltin_event(triggered_by, resource):
+    entity = triggered_by.split('.', 1)[0]
+    if entity == 'file':
+        image_cache.invalidate_image_url(resource['id'])
+    if triggered_by == 'file.deleted':
+        image_cache.forget_image_file(resource['id'])
+    if entity in ['product', 'category', 'file']:
+        catalog_cache.invalidate_catalog()
+        fb_cache.schedule_update(triggered_by, resource)
+    if '/flows/pizzeria/' in resource.get('links', {}).get('self', ''):
+        pizzeria_index.invalidate_index()
+        delivery_zones.schedule_zone_map_rebuild()
+
+
+def handle_messaging_event(messaging_event):
+    postback = None
+    sender_id = messaging_event['sender']['id']
+    if messaging_event.get('message'):
+        message_text = messaging_event['message']['text']
+    if messaging_event.get('postback'):
+        message_text = messaging_event['postback']['title']
+        postback = messaging_event['postback']['payload']
+    handle_users_reply(sender_id, message_text, postback)
+
+
 def handle_users_reply(sender_id, message_text, postback=None):
     states_functions = {
         'START': handle_start,
@@ -86,18 +118,28 @@ def send_menu(recipient_id, category_id=None):
 
 
 def send_message(recipient_id, message_payload):
+    '''
+    message_payload is a dict or an already serialized json message.
+    '''
     params = {'access_token': FACEBOOK_TOKEN}
     headers = {'Content-Type': 'application/json'}
-    request_content = {
-        'recipient': {
-            'id': recipient_id
-        },
-        'message': message_payload,
-    }
-
-    response = requests.post(
+    if isinstance(message_payload, bytes):
+        request_content = b''.join([
+            b'{"recipient": ', json.dumps({'id': recipient_id}).encode('utf-8'),
+            b', "message": ', message_payload, b'}',
+        ])
+    else:
+        request_content = json.dumps({
+            'recipient': {
+                'id': recipient_id
+            },
+            'message': message_payload,
+        }).encode('utf-8')
+
+    session = http_sessions.get_session('graph.facebook.com')
+    response = session.post(
         'https://graph.facebook.com/v7.0/me/messages',
-        params=params, headers=headers, json=request_content
+        params=params, headers=headers, data=request_content, timeout=http_sessions.TIMEOUT
     )
     response.raise_for_status()
 
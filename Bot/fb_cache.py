@@ -1,29 +1,189 @@
+from concurrent.futures import ThreadPoolExecutor
 import json
+import logging
+import os
 
 import db_aps
 import fb_templates
+import image_cache
 import moltin_aps
+import scheduled_jobs
 
 
 DB = db_aps.get_database_connection()
 
+cache_logger = logging.getLogger('cache_logger')
+
+UPDATE_WORKERS = int(os.getenv('FB_CACHE_UPDATE_WORKERS', 8))
+DEBOUNCE_DELAY = float(os.getenv('FB_CACHE_DEBOUNCE_DELAY', 5))
+RETRY_DELAY = float(os.getenv('FB_CACHE_RETRY_DELAY', 60))
+PENDING_CATEGORIES_KEY = 'fb_cache:pending_categories'
+UPDATE_JOB = 'fb_cache_update'
+PRODUCT_CATEGORIES_KEY = 'fb_product_categories'
+MENU_CATEGORIES_KEY = 'fb_menu_categories'
+CARDS_VERSION_KEY = 'fb_cards_version'
+ALL_CATEGORIES = '*'
+CATEGORIES_CARD = 'categories_card'
+
 
 def update_cached_cards():
-    update_menu_cards()
-    update_category_card()
+    image_cache.warm_up()
+    category_ids = [category['id'] for category in moltin_aps.get_all_categories()]
+    update_cards(category_ids, update_categories_card=True, reset_product_categories=True)
+
+
+def update_cards(category_ids, update_categories_card=False, reset_product_categories=False):
+    '''
+    Collect product cards of categories concurrently and save all of them
+    in one transaction, so readers never see a half-built menu.
+    '''
+    with ThreadPoolExecutor(max_workers=UPDATE_WORKERS) as executor:
+        categories_card = executor.submit(fb_templates.collect_categories_card) if update_categories_card else None
+        menu_cards = dict(zip(category_ids, executor.map(collect_category_menu_cards, category_ids)))
+        categories_card = categories_card.result() if categories_card else None
+
+    product_categories = collect_product_categories(menu_cards, reset_product_categories)
+    menu_payloads = collect_menu_payloads(menu_cards, categories_card, reset_product_categories)
+    pipeline = DB.pipeline(transaction=True)
+    if reset_product_categories:
+        pipeline.delete(PRODUCT_CATEGORIES_KEY, MENU_CATEGORIES_KEY)
+    for category_id, (products, product_cards) in menu_cards.items():
+        pipeline.set(f'fb_menu:{category_id}', json.dumps(product_cards))
+    if categories_card is not None:
+        pipeline.set('categories_card', json.dumps(categories_card))
+    if product_categories:
+        pipeline.hmset(PRODUCT_CATEGORIES_KEY, product_categories)
+    if menu_cards:
+        pipeline.sadd(MENU_CATEGORIES_KEY, *menu_cards)
+    for category_id, menu_payload in menu_payloads.items():
+        pipeline.set(f'fb_menu_payload:{category_id}', menu_payload)
+    publish_cards_update(pipeline)
+    pipeline.execute()
+
+
+def publish_cards_update(pipeline):
+    '''
+    Bump cards version and tell every process to drop its local copies of cards.
+    '''
+    cards_version = DB.incr(CARDS_VERSION_KEY)
+    pipeline.publish(fb_templates.CARDS_CHANNEL, cards_version)
+
+
+def collect_menu_payloads(menu_cards, categories_card=None, full_rebuild=False):
+    '''
+    Serialized menu payloads of rebuilt categories. Every payload holds the categories card,
+    so its update rebuilds payloads of all categories, using saved product cards of the rest.
+    '''
+    product_cards = {category_id: cards for category_id, (products, cards) in menu_cards.items()}
+    if categories_card is None:
+        categories_card = fb_templates.get_categories_card()
+    elif not full_rebuild:
+        category_ids = [category_id.decode('utf-8') for category_id in DB.smembers(MENU_CATEGORIES_KEY)]
+        category_ids = [category_id for category_id in category_ids if category_id not in product_cards]
+        saved_cards = DB.mget([f'fb_menu:{category_id}' for category_id in category_ids]) if category_ids else []
+        for category_id, cards in zip(category_ids, saved_cards):
+            if cards is not None:
+                product_cards[category_id] = json.loads(cards)
+    return {
+        category_id: fb_templates.collect_menu_payload(cards, categories_card)
+        for category_id, cards in product_cards.items()
+    }
+
+
+def collect_category_menu_cards(category_id):
+    products = moltin_aps.get_products_by_category_id(category_id, 'sort=name')
+    product_cards = fb_templates.collect_product_cards(products)
+    return products, product_cards
+
+
+def collect_product_categories(menu_cards, reset_product_categories=False):
+    '''
+    Reverse index product → categories, so events without category relationships
+    (e.g. product deletion) can still find the category cards to rebuild.
+    '''
+    product_categories = {}
+    for category_id, (products, product_cards) in menu_cards.items():
+        for product in products:
+            product_categories.setdefault(product['id'], set()).add(category_id)
+    if not product_categories:
+        return {}
+    product_ids = list(product_categories)
+    if not reset_product_categories:
+        known_categories = DB.hmget(PRODUCT_CATEGORIES_KEY, product_ids)
+        for product_id, categories in zip(product_ids, known_categories):
+            if categories:
+                product_categories[product_id].update(categories.decode('utf-8').split(','))
+    return {product_id: ','.join(sorted(categories)) for product_id, categories in product_categories.items()}
+
+
+def collect_affected_cards(triggered_by, resource):
+    '''
+    Category ids whose product cards depend on moltin event, plus CATEGORIES_CARD
+    if the categories card depends on it.
+    '''
+    entity, action = triggered_by.split('.', 1)
+    if entity == 'category':
+        if action == 'deleted':
+            pipeline = DB.pipeline(transaction=True)
+            pipeline.delete(f'fb_menu:{resource["id"]}', f'fb_menu_payload:{resource["id"]}')
+            pipeline.srem(MENU_CATEGORIES_KEY, resource['id'])
+            publish_cards_update(pipeline)
+            pipeline.execute()
+            return {CATEGORIES_CARD}
+        return {resource['id'], CATEGORIES_CARD}
+    if entity == 'product':
+        relationships = resource.get('relationships') or {}
+        categories = (relationships.get('categories') or {}).get('data') or []
+        affected_cards = {category['id'] for category in categories}
+        known_categories = DB.hget(PRODUCT_CATEGORIES_KEY, resource['id'])
+        if known_categories:
+            affected_cards.update(known_categories.decode('utf-8').split(','))
+        return affected_cards
+    if entity == 'file':
+        return {ALL_CATEGORIES}
+    return set()
+
+
+def schedule_update(triggered_by, resource):
+    '''
+    Collect cards affected by moltin event and rebuild them after DEBOUNCE_DELAY,
+    so a burst of events from bulk catalog edits costs a single rebuild.
+    Cards are rebuilt by fb_worker, pending ones are kept in db until it does.
+    '''
+    affected_cards = collect_affected_cards(triggered_by, resource)
+    if not affected_cards:
+        return
+    pipeline = DB.pipeline(transaction=True)
+    pipeline.sadd(PENDING_CATEGORIES_KEY, *affected_cards)
+    scheduled_jobs.schedule_job(UPDATE_JOB, DEBOUNCE_DELAY, pipeline)
+    pipeline.execute()
 
 
-def update_menu_cards():
-    categories = moltin_aps.get_all_categories()
-    for category in categories:
-        products = moltin_aps.get_products_by_category_id(category['id'], 'sort=name')
-        product_cards = fb_templates.collect_product_cards(products)
-        product_cards = json.dumps(product_cards)
-        db_key = 'fb_menu:{}'.format(category['id'])
-        DB.set(db_key, product_cards)
+def apply_pending_updates():
+    '''
+    Failed cards are returned to pending ones and rebuilt again after RETRY_DELAY.
+    '''
+    pipeline = DB.pipeline(transaction=True)
+    pipeline.smembers(PENDING_CATEGORIES_KEY)
+    pipeline.delete(PENDING_CATEGORIES_KEY)
+    pending_cards, _ = pipeline.execute()
+    pending_cards = {card.decode('utf-8') for card in pending_cards}
+    if not pending_cards:
+        return
+    try:
+        update_pending_cards(set(pending_cards))
+    except Exception:
+        pipeline = DB.pipeline(transaction=True)
+        pipeline.sadd(PENDING_CATEGORIES_KEY, *pending_cards)
+        scheduled_jobs.schedule_job(UPDATE_JOB, RETRY_DELAY, pipeline)
+        pipeline.execute()
+        raise
 
 
-def update_category_card():
-    categories_card = fb_templates.collect_categories_card()
-    categories_card = json.dumps(categories_card)
-    DB.set('categories_card', categories_card)
+def update_pending_cards(pending_cards):
+    if ALL_CATEGORIES in pending_cards:
+        update_cached_cards()
+        return
+    update_categories_card = CATEGORIES_CARD in pending_cards
+    pending_cards.discard(CATEGORIES_CARD)
+    update_cards(list(pending_cards), update_categories_card)
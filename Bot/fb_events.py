@@ -0,0 +1,40 @@
+import json
+import logging
+import os
+import zlib
+
+import db_aps
+
+
+events_logger = logging.getLogger('events_logger')
+
+EVENT_SHARDS = int(os.getenv('FB_EVENT_SHARDS', 4))
+STREAM_MAX_LENGTH = int(os.getenv('FB_EVENT_STREAM_MAX_LENGTH', 100000))
+CONSUMER_GROUP = 'fb_workers'
+
+
+def get_stream_key(shard):
+    return f'fb_events:{shard}'
+
+
+def get_sender_shard(sender_id):
+    '''
+    All events of one sender go to the same shard, so they are handled in order.
+    '''
+    return zlib.crc32(str(sender_id).encode('utf-8')) % EVENT_SHARDS
+
+
+def enqueue_messaging_event(messaging_event):
+    db = db_aps.get_database_connection()
+    sender_id = messaging_event['sender']['id']
+    stream_key = get_stream_key(get_sender_shard(sender_id))
+    fields = {
+        'sender_id': sender_id,
+        'event': json.dumps(messaging_event),
+    }
+    db.xadd(stream_key, fields, maxlen=STREAM_MAX_LENGTH, approximate=True)
+    events_logger.debug(f'Event from «{sender_id}» was added to {stream_key}')
+
+
+def parse_stream_entry(fields):
+    return fields[b'sender_id'].decode('utf-8'), json.loads(fields[b'event'])
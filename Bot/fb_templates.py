@@ -1,13 +1,29 @@
+from collections import OrderedDict
 from copy import deepcopy
 import json
 import os
+import threading
+import time
 
 import db_aps
+import image_cache
 import moltin_aps
 
 
 DB = db_aps.get_database_connection()
 
+RECIPIENT_PLACEHOLDER = '%RECIPIENT_ID%'
+CARDS_CHANNEL = 'fb_cards_updates'
+LOCAL_CACHE_SIZE = int(os.getenv('FB_LOCAL_CACHE_SIZE', 256))
+LOCAL_CACHE_TTL = int(os.getenv('FB_LOCAL_CACHE_TTL', 30))
+
+_local_cards = {
+    'version': None,
+    'subscribed_pid': None,
+    'values': OrderedDict(),
+}
+_local_cards_lock = threading.Lock()
+
 GENERIC_TEMPLATE = {
     'attachment': {
         'type': 'template',
@@ -21,13 +37,25 @@ GENERIC_TEMPLATE = {
 
 
 def collect_menu_message(recipient_id, category_id=None):
-    message_payload = deepcopy(GENERIC_TEMPLATE)
+    '''
+    Serialized menu payload with recipient id patched in.
+    '''
     if category_id is None:
         category_id = os.environ['FRONT_PAGE_CAT_ID']
+    menu_payload = get_menu_payload(category_id)
+    return menu_payload.replace(RECIPIENT_PLACEHOLDER.encode('utf-8'), str(recipient_id).encode('utf-8'))
+
 
-    menu_card = collect_menu_card(recipient_id)
-    product_cards = get_product_cards(category_id)
-    categories_card = get_categories_card()
+def get_menu_payload(category_id):
+    menu_payload = get_cached_value(f'fb_menu_payload:{category_id}')
+    if menu_payload is None:
+        menu_payload = collect_menu_payload(get_product_cards(category_id), get_categories_card())
+    return menu_payload
+
+
+def collect_menu_payload(product_cards, categories_card):
+    message_payload = deepcopy(GENERIC_TEMPLATE)
+    menu_card = collect_menu_card(RECIPIENT_PLACEHOLDER)
 
     # Note: facebook can take up to 10 templates in carousel of generic templates
     message_payload['attachment']['payload']['elements'].extend([
@@ -35,7 +63,7 @@ def collect_menu_message(recipient_id, category_id=None):
         *product_cards[:8],  # TODO handle menu with more then 8 items
         categories_card,
     ])
-    return message_payload
+    return json.dumps(message_payload).encode('utf-8')
 
 
 def collect_menu_card(recipient_id):
@@ -64,16 +92,61 @@ def collect_menu_card(recipient_id):
 
 
 def get_product_cards(category_id):
-    db_key = f'fb_menu:{category_id}'
-    product_cards = DB.get(db_key).decode('UTF-8')
-    product_cards = json.loads(product_cards)
-    return product_cards
+    return get_cached_value(f'fb_menu:{category_id}', json.loads)
 
 
 def get_categories_card():
-    categories_card = DB.get('categories_card').decode('utf-8')
-    categories_card = json.loads(categories_card)
-    return categories_card
+    return get_cached_value('categories_card', json.loads)
+
+
+def get_cached_value(db_key, parse=None):
+    '''
+    Two-tier cache: in-process LRU in front of db. Local entries live at most
+    LOCAL_CACHE_TTL seconds and are dropped at once when fb_cache publishes
+    a new cards version.
+    '''
+    check_cards_subscription()
+    now = time.monotonic()
+    with _local_cards_lock:
+        cached_entry = _local_cards['values'].get(db_key)
+        if cached_entry and cached_entry[0] > now:
+            _local_cards['values'].move_to_end(db_key)
+            return cached_entry[1]
+        version = _local_cards['version']
+
+    value = DB.get(db_key)
+    if value is None:
+        return None
+    if parse:
+        value = parse(value)
+    with _local_cards_lock:
+        if _local_cards['version'] == version:
+            _local_cards['values'][db_key] = (now + LOCAL_CACHE_TTL, value)
+            if len(_local_cards['values']) > LOCAL_CACHE_SIZE:
+                _local_cards['values'].popitem(last=False)
+    return value
+
+
+def check_cards_subscription():
+    '''
+    Subscribe every process (and every forked gunicorn worker) to cards updates.
+    '''
+    if _local_cards['subscribed_pid'] == os.getpid():
+        return
+    with _local_cards_lock:
+        if _local_cards['subscribed_pid'] == os.getpid():
+            return
+        pubsub = DB.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{CARDS_CHANNEL: handle_cards_update})
+        pubsub.run_in_thread(sleep_time=1, daemon=True)
+        _local_cards['subscribed_pid'] = os.getpid()
+        _local_cards['values'].clear()
+
+
+def handle_cards_update(message):
+    with _local_cards_lock:
+        _local_cards['version'] = message['data']
+        _local_cards['values'].clear()
 
 
 def collect_categories_card():
@@ -103,7 +176,7 @@ def collect_product_cards(products):
             price=product['meta']['display_price']['with_tax']['formatted']
         )
         image_id = product['relationships']['main_image']['data']['id']
-        image_url = moltin_aps.get_file_info(image_id)['link']['href']
+        image_url = image_cache.get_image_url(image_id)
         product_cards.append({
             'title': title,
             'image_url': image_url,
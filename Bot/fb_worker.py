@@ -0,0 +1,239 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+import redis
+
+import db_aps
+import delivery_zones
+import fb_bot
+import fb_cache
+import fb_events
+import log_config
+import scheduled_jobs
+
+
+events_logger = logging.getLogger('events_logger')
+
+BATCH_SIZE = int(os.getenv('FB_WORKER_BATCH_SIZE', 100))
+SENDER_WORKERS = int(os.getenv('FB_WORKER_SENDER_WORKERS', 16))
+MAX_OUTSTANDING_EVENTS = int(os.getenv('FB_WORKER_MAX_OUTSTANDING_EVENTS', 1000))
+LEASE_TIMEOUT = int(os.getenv('FB_WORKER_LEASE_TIMEOUT', 30))
+CLAIM_IDLE_TIME = int(os.getenv('FB_WORKER_CLAIM_IDLE_TIME', 60000))
+LEASE_RETRY_DELAY = 5
+READ_TIMEOUT = 5000
+SCHEDULED_JOBS = {
+    fb_cache.UPDATE_JOB: fb_cache.apply_pending_updates,
+    delivery_zones.REBUILD_JOB: delivery_zones.rebuild_zone_map,
+}
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[log_config.SendToTelegramHandler()],
+        level='ERROR',
+    )
+    shards = os.getenv('FB_WORKER_SHARDS')
+    if shards:
+        shards = [int(shard) for shard in shards.split(',')]
+    else:
+        shards = range(fb_events.EVENT_SHARDS)
+
+    threading.Thread(target=scheduled_jobs.run_jobs_forever, args=(SCHEDULED_JOBS,),
+                     name='scheduled_jobs', daemon=True).start()
+    with ThreadPoolExecutor(max_workers=SENDER_WORKERS) as executor:
+        threads = [
+            threading.Thread(target=serve_shard, args=(shard, executor), name=f'fb_shard_{shard}')
+            for shard in shards
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+def serve_shard(shard, executor):
+    '''
+    Each shard is consumed by one worker process at a time, the one holding the shard lease:
+    events of one sender are handled in order, events of different senders are handled in parallel.
+    Other processes wait to take the lease over if the holder dies.
+    '''
+    while True:
+        try:
+            lease = acquire_shard_lease(shard)
+            if lease is not None:
+                try:
+                    consume_shard(shard, lease, executor)
+                finally:
+                    release_shard_lease(lease)
+        except Exception:
+            events_logger.exception(f'Shard {shard} consuming failed')
+        time.sleep(LEASE_RETRY_DELAY)
+
+
+def get_lease_key(shard):
+    return f'fb_events_lease:{shard}'
+
+
+def get_consumer_name(shard):
+    '''
+    Consumer name is the same for every holder of the shard lease,
+    so the next holder replays events which were read but not acknowledged.
+    '''
+    return f'shard_{shard}'
+
+
+def acquire_shard_lease(shard):
+    token = db_aps.acquire_lock(get_lease_key(shard), LEASE_TIMEOUT, blocking=False)
+    if token is None:
+        return None
+    lease = {
+        'key': get_lease_key(shard),
+        'token': token,
+        'lost': threading.Event(),
+        'released': threading.Event(),
+    }
+    threading.Thread(target=keep_shard_lease, args=(lease,), name=f'fb_lease_{shard}', daemon=True).start()
+    events_logger.debug(f'Lease of shard {shard} was acquired')
+    return lease
+
+
+def keep_shard_lease(lease):
+    while not lease['released'].wait(LEASE_TIMEOUT / 3):
+        try:
+            is_renewed = db_aps.renew_lock(lease['key'], lease['token'], LEASE_TIMEOUT)
+        except redis.RedisError:
+            events_logger.exception(f'{lease["key"]} renewal failed')
+            continue
+        if not is_renewed:
+            lease['lost'].set()
+            return
+
+
+def release_shard_lease(lease):
+    lease['released'].set()
+    db_aps.release_lock(lease['key'], lease['token'])
+
+
+def consume_shard(shard, lease, executor):
+    db = db_aps.get_database_connection()
+    stream_key = fb_events.get_stream_key(shard)
+    consumer_name = get_consumer_name(shard)
+    try:
+        db.xgroup_create(stream_key, fb_events.CONSUMER_GROUP, id='0', mkstream=True)
+    except redis.ResponseError:
+        events_logger.debug(f'Consumer group for {stream_key} already exists')
+    claim_idle_entries(stream_key, consumer_name)
+
+    chains = {
+        'stream_key': stream_key,
+        'senders': {},
+        'lock': threading.Lock(),
+        'outstanding': threading.BoundedSemaphore(MAX_OUTSTANDING_EVENTS),
+    }
+    try:
+        # first handle events which were read but not acknowledged by the previous lease holder
+        last_id = '0'
+        while not lease['lost'].is_set():
+            streams = db.xreadgroup(fb_events.CONSUMER_GROUP, consumer_name, {stream_key: last_id},
+                                    count=BATCH_SIZE, block=READ_TIMEOUT)
+            entries = streams[0][1] if streams else []
+            if last_id != '>':
+                # pending events stay pending until handled, so reading them goes on after the last one
+                last_id = entries[-1][0] if entries else '>'
+            for entry_id, fields in entries:
+                add_sender_event(chains, entry_id, fields, executor)
+        events_logger.error(f'Lease of shard {shard} was lost')
+    finally:
+        wait_sender_chains(chains)
+
+
+def add_sender_event(chains, entry_id, fields, executor):
+    '''
+    Events of one sender are handled in order by one chain, chains of different senders
+    don't wait for each other. Each event is acknowledged as soon as it is handled,
+    reading waits while MAX_OUTSTANDING_EVENTS events are not handled yet.
+    '''
+    chains['outstanding'].acquire()
+    if not fields:
+        ack_entry(chains, entry_id)
+        return
+    sender_id, messaging_event = fb_events.parse_stream_entry(fields)
+    with chains['lock']:
+        sender_chain = chains['senders'].get(sender_id)
+        is_running = sender_chain is not None
+        if not is_running:
+            sender_chain = chains['senders'][sender_id] = deque()
+        sender_chain.append((entry_id, messaging_event))
+    if not is_running:
+        executor.submit(run_sender_chain, chains, sender_id)
+
+
+def run_sender_chain(chains, sender_id):
+    while True:
+        with chains['lock']:
+            sender_chain = chains['senders'][sender_id]
+            if not sender_chain:
+                del chains['senders'][sender_id]
+                return
+            entry_id, messaging_event = sender_chain.popleft()
+        try:
+            fb_bot.handle_messaging_event(messaging_event)
+        except Exception:
+            events_logger.exception('Facebook event handling failed')
+        ack_entry(chains, entry_id)
+
+
+def ack_entry(chains, entry_id):
+    db = db_aps.get_database_connection()
+    try:
+        db.xack(chains['stream_key'], fb_events.CONSUMER_GROUP, entry_id)
+    except redis.RedisError:
+        events_logger.exception(f'Event {entry_id} acknowledgement failed')
+    finally:
+        chains['outstanding'].release()
+
+
+def wait_sender_chains(chains):
+    '''
+    Events read under the lease are handled before the lease is released.
+    '''
+    for _ in range(MAX_OUTSTANDING_EVENTS):
+        chains['outstanding'].acquire()
+    for _ in range(MAX_OUTSTANDING_EVENTS):
+        chains['outstanding'].release()
+
+
+def claim_idle_entries(stream_key, consumer_name):
+    '''
+    Take over events left unacknowledged by consumers with other names, e.g. of older worker versions.
+    '''
+    db = db_aps.get_database_connection()
+    start_id = '-'
+    while True:
+        pending_entries = db.xpending_range(stream_key, fb_events.CONSUMER_GROUP, start_id, '+', BATCH_SIZE)
+        idle_ids = [
+            entry['message_id'] for entry in pending_entries
+            if entry['consumer'].decode('utf-8') != consumer_name and entry['time_since_delivered'] >= CLAIM_IDLE_TIME
+        ]
+        if idle_ids:
+            db.xclaim(stream_key, fb_events.CONSUMER_GROUP, consumer_name, CLAIM_IDLE_TIME, idle_ids)
+            events_logger.debug(f'{len(idle_ids)} idle events of {stream_key} were claimed')
+        if len(pending_entries) < BATCH_SIZE:
+            return
+        start_id = get_next_entry_id(pending_entries[-1]['message_id'])
+
+
+def get_next_entry_id(entry_id):
+    timestamp, sequence = entry_id.decode('utf-8').split('-')
+    return f'{timestamp}-{int(sequence) + 1}'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import logging
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+http_logger = logging.getLogger('http_logger')
+
+POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 10))
+MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 1))
+
+_sessions = {}
+_sessions_pid = None
+
+
+def get_session(host):
+    '''
+    Keep-alive session with connection pool for host. Sessions are created per process,
+    so gunicorn workers forked from master never share sockets.
+    '''
+    global _sessions_pid
+    if _sessions_pid != os.getpid():
+        _sessions.clear()
+        _sessions_pid = os.getpid()
+    session = _sessions.get(host)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=MAX_RETRIES)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _sessions[host] = session
+        http_logger.debug(f'Got new http session for {host}')
+    return session
@@ -0,0 +1,194 @@
+from collections import OrderedDict
+import logging
+import os
+import threading
+
+import catalog_cache
+import db_aps
+import moltin_aioaps
+import moltin_aps
+import moltin_requests
+
+
+cache_logger = logging.getLogger('cache_logger')
+
+IMAGE_HREFS_KEY = 'file_hrefs'
+TELEGRAM_FILE_IDS_KEY = 'tg_photo_file_ids'
+IMAGE_FILES_KEY = 'image_files'
+IMAGE_HASHES_KEY = 'image_file_hashes'
+LOCAL_CACHE_SIZE = int(os.getenv('IMAGE_CACHE_SIZE', 1024))
+UPLOAD_LOCK_TIMEOUT = 60
+
+_local_cache = {
+    'version': None,
+    'hrefs': OrderedDict(),
+}
+_local_cache_lock = threading.Lock()
+
+
+def get_image_url(file_id):
+    version = catalog_cache.get_current_catalog_version()
+    href = get_local_image_url(file_id, version) or get_cached_image_url(file_id)
+    if href is None:
+        href = moltin_aps.get_file_info(file_id)['link']['href']
+        save_image_urls({file_id: href})
+    return href
+
+
+async def async_get_image_url(file_id):
+    version = await catalog_cache.async_get_current_catalog_version()
+    href = get_local_image_url(file_id, version) or await async_get_cached_image_url(file_id)
+    if href is None:
+        href = (await moltin_aioaps.get_file_info(file_id))['link']['href']
+        await async_save_image_urls({file_id: href})
+    return href
+
+
+def get_local_image_url(file_id, version):
+    '''
+    Local cache is shared by threads of the Facebook app and by the event loop of the telegram bot.
+    '''
+    with _local_cache_lock:
+        if version != _local_cache['version']:
+            _local_cache['hrefs'].clear()
+            _local_cache['version'] = version
+        hrefs = _local_cache['hrefs']
+        href = hrefs.get(file_id)
+        if href is not None:
+            hrefs.move_to_end(file_id)
+    return href
+
+
+def remember_image_url(file_id, href):
+    with _local_cache_lock:
+        hrefs = _local_cache['hrefs']
+        hrefs[file_id] = href
+        hrefs.move_to_end(file_id)
+        while len(hrefs) > LOCAL_CACHE_SIZE:
+            hrefs.popitem(last=False)
+
+
+def get_cached_image_url(file_id):
+    db = db_aps.get_database_connection()
+    href = db.hget(IMAGE_HREFS_KEY, file_id)
+    if href is None:
+        return None
+    href = href.decode('utf-8')
+    remember_image_url(file_id, href)
+    return href
+
+
+async def async_get_cached_image_url(file_id):
+    db = await db_aps.get_async_database_connection()
+    href = await db.hget(IMAGE_HREFS_KEY, file_id)
+    if href is None:
+        return None
+    href = href.decode('utf-8')
+    remember_image_url(file_id, href)
+    return href
+
+
+def save_image_urls(hrefs):
+    if not hrefs:
+        return
+    db = db_aps.get_database_connection()
+    db.hmset(IMAGE_HREFS_KEY, hrefs)
+    for file_id, href in hrefs.items():
+        remember_image_url(file_id, href)
+    cache_logger.debug(f'{len(hrefs)} image urls were cached')
+
+
+async def async_save_image_urls(hrefs):
+    if not hrefs:
+        return
+    db = await db_aps.get_async_database_connection()
+    await db.hmset_dict(IMAGE_HREFS_KEY, hrefs)
+    for file_id, href in hrefs.items():
+        remember_image_url(file_id, href)
+    cache_logger.debug(f'{len(hrefs)} image urls were cached')
+
+
+def collect_included_image_urls(page):
+    main_images = (page.get('included') or {}).get('main_images', [])
+    return {image['id']: image['link']['href'] for image in main_images}
+
+
+def warm_up():
+    '''
+    Cache main image urls of all products using moltin `include=main_images`.
+    '''
+    payload = {'include': 'main_images'}
+    for page in moltin_requests.iterate_pages('products', payload):
+        save_image_urls(collect_included_image_urls(page))
+
+
+def invalidate_image_url(file_id):
+    db = db_aps.get_database_connection()
+    db.hdel(IMAGE_HREFS_KEY, file_id)
+    with _local_cache_lock:
+        _local_cache['hrefs'].pop(file_id, None)
+    cache_logger.debug(f'Image url of file «{file_id}» was invalidated')
+
+
+def upload_image(img_url):
+    '''
+    Moltin file id of image. Images are indexed by content hash and uploads
+    of the same content wait for each other, so the same image is uploaded to moltin once.
+    '''
+    image_name, image_file, content_hash = moltin_aps.download_image(img_url)
+    file_id = get_image_file_id(content_hash)
+    if file_id is not None:
+        cache_logger.debug(f'Image {image_name} is already uploaded as file «{file_id}»')
+        return file_id
+
+    lock_key = f'{IMAGE_FILES_KEY}:{content_hash}'
+    token = db_aps.acquire_lock(lock_key, UPLOAD_LOCK_TIMEOUT)
+    try:
+        file_id = get_image_file_id(content_hash)
+        if file_id is not None:
+            cache_logger.debug(f'Image {image_name} was uploaded meanwhile as file «{file_id}»')
+            return file_id
+        file_id = moltin_aps.create_file(image_name, image_file, 'true')['id']
+        db = db_aps.get_database_connection()
+        pipeline = db.pipeline()
+        pipeline.hset(IMAGE_FILES_KEY, content_hash, file_id)
+        pipeline.hset(IMAGE_HASHES_KEY, file_id, content_hash)
+        pipeline.execute()
+    finally:
+        db_aps.release_lock(lock_key, token)
+    return file_id
+
+
+def get_image_file_id(content_hash):
+    db = db_aps.get_database_connection()
+    file_id = db.hget(IMAGE_FILES_KEY, content_hash)
+    return file_id.decode('utf-8') if file_id else None
+
+
+def forget_image_file(file_id):
+    '''
+    Called on moltin file deletion, so the image is uploaded again next time.
+    '''
+    db = db_aps.get_database_connection()
+    content_hash = db.hget(IMAGE_HASHES_KEY, file_id)
+    pipeline = db.pipeline()
+    if content_hash:
+        pipeline.hdel(IMAGE_FILES_KEY, content_hash)
+    pipeline.hdel(IMAGE_HASHES_KEY, file_id)
+    pipeline.execute()
+
+
+async def async_get_telegram_file_id(product_id, image_id):
+    '''
+    Telegram file_id of product photo. Key includes image id, so a new main image
+    of product is uploaded to telegram again.
+    '''
+    db = await db_aps.get_async_database_connection()
+    file_id = await db.hget(TELEGRAM_FILE_IDS_KEY, f'{product_id}:{image_id}')
+    return file_id.decode('utf-8') if file_id else None
+
+
+async def async_save_telegram_file_id(product_id, image_id, file_id):
+    db = await db_aps.get_async_database_connection()
+    await db.hset(TELEGRAM_FILE_IDS_KEY, f'{product_id}:{image_id}', file_id)
+    cache_logger.debug(f'Telegram file_id of product «{product_id}» photo was saved')
@@ -0,0 +1,84 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import logging
+import os
+
+from dotenv import load_dotenv
+
+import catalog_cache
+import db_aps
+import image_cache
+import moltin_aps
+
+
+import_logger = logging.getLogger('import_logger')
+
+IMPORT_WORKERS = int(os.getenv('IMPORT_WORKERS', 8))
+IMPORTED_SKUS_KEY = 'menu_import:imported_skus'
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level='INFO')
+    parser = argparse.ArgumentParser(description='Load pizzas from menu json file to moltin')
+    parser.add_argument('menu_path', help='path to json file with the list of pizzas')
+    parser.add_argument('--workers', type=int, default=IMPORT_WORKERS, help='pizzas imported at once')
+    parser.add_argument('--restart', action='store_true', help='check again pizzas imported by previous runs')
+    args = parser.parse_args()
+
+    with open(args.menu_path, encoding='utf-8') as menu_file:
+        menu = json.load(menu_file)
+    failed_skus = import_menu(menu, args.workers, args.restart)
+    if failed_skus:
+        import_logger.error(f'Pizzas {", ".join(failed_skus)} were not imported, run the import again to resume')
+
+
+def import_menu(menu, workers=IMPORT_WORKERS, restart=False):
+    '''
+    Import is idempotent by sku: pizzas which are already in moltin are not created again,
+    only their missing images are added. Skus of imported pizzas are saved to db,
+    so the next run resumes after failure without checking them again.
+    '''
+    db = db_aps.get_database_connection()
+    if restart:
+        db.delete(IMPORTED_SKUS_KEY)
+    imported_skus = {sku.decode('utf-8') for sku in db.smembers(IMPORTED_SKUS_KEY)}
+    pizzas = [pizza for pizza in menu if str(pizza['id']) not in imported_skus]
+    products = {product['sku']: product for product in moltin_aps.iterate_products(prefetch=True)}
+    import_logger.info(f'{len(menu) - len(pizzas)} of {len(menu)} pizzas were imported before')
+
+    failed_skus = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='menu_import') as executor:
+        futures = {
+            executor.submit(import_pizza, pizza, products.get(str(pizza['id']))): str(pizza['id'])
+            for pizza in pizzas
+        }
+        for done_count, future in enumerate(as_completed(futures), start=1):
+            sku = futures[future]
+            try:
+                future.result()
+            except Exception:
+                import_logger.exception(f'Pizza «{sku}» import failed')
+                failed_skus.append(sku)
+            else:
+                db.sadd(IMPORTED_SKUS_KEY, sku)
+            import_logger.info(f'{done_count} of {len(pizzas)} pizzas processed, {len(failed_skus)} failed')
+
+    if len(failed_skus) < len(pizzas):
+        catalog_cache.invalidate_catalog()
+    return failed_skus
+
+
+def import_pizza(pizza, product=None):
+    if product is None:
+        pizza_info = moltin_aps.collect_pizza_info(pizza['id'], pizza['name'], pizza['description'], pizza['price'])
+        product = moltin_aps.create_product(pizza_info)
+    if not product.get('relationships', {}).get('main_image'):
+        image_id = image_cache.upload_image(pizza['product_image']['url'])
+        moltin_aps.add_product_main_image(product['id'], image_id)
+    import_logger.debug(f'Pizza «{pizza["id"]}» was imported')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import logging
+
+import cart_mirror
+import moltin_aiorequests
+
+
+moltin_logger = logging.getLogger('moltin_loger')
+
+APP_JSON_HEADER = {'Content-Type': 'application/json'}
+
+
+async def get_all_categories(sort=None):
+    categories = [category async for category in iterate_categories(sort)]
+    return categories
+
+
+async def iterate_categories(sort=None, page_limit=moltin_aiorequests.PAGE_LIMIT, prefetch=False):
+    method = f'categories?{sort}'
+    async for page in moltin_aiorequests.iterate_pages(method, page_limit=page_limit, prefetch=prefetch):
+        for category in page['data']:
+            yield category
+
+
+async def get_products_by_category_id(category_id, sort=None):
+    method = f'products?filter=eq(category.id,{category_id})&{sort}'
+    products = [product async for page in moltin_aiorequests.iterate_pages(method) for product in page['data']]
+    return products
+
+
+async def update_entry(entry_values, flow_slug, entry_id):
+    method = f'flows/{flow_slug}/entries/{entry_id}'
+    payload = {'data': {'id': entry_id, 'type': 'entry'}}
+    payload['data'].update(entry_values)
+    updated_entry_info = await moltin_aiorequests.make_put_request(method, payload=payload)
+    return updated_entry_info
+
+
+async def get_entry(flow_slug, entry_id):
+    method = f'flows/{flow_slug}/entries/{entry_id}'
+    entry_info = await moltin_aiorequests.make_get_request(method)
+    return entry_info
+
+
+async def get_all_entries(flow_slug):
+    entries = [entry async for entry in iterate_entries(flow_slug)]
+    return entries
+
+
+async def iterate_entries(flow_slug, page_limit=moltin_aiorequests.PAGE_LIMIT, prefetch=False):
+    method = f'flows/{flow_slug}/entries'
+    async for page in moltin_aiorequests.iterate_pages(method, page_limit=page_limit, prefetch=prefetch):
+        for entry in page['data']:
+            yield entry
+
+
+async def add_field_entry(entry_values, flow_slug):
+    method = f'flows/{flow_slug}/entries'
+    payload = {'data': {'type': 'entry'}}
+    payload['data'].update(entry_values)
+    entry_info = (await moltin_aiorequests.make_post_request(method, APP_JSON_HEADER, payload=payload))['data']
+    return entry_info
+
+
+async def get_all_products():
+    products = [product async for product in iterate_products()]
+    moltin_logger.debug('Got all products')
+    return products
+
+
+async def iterate_products(page_limit=moltin_aiorequests.PAGE_LIMIT, prefetch=False):
+    method = 'products'
+    async for page in moltin_aiorequests.iterate_pages(method, page_limit=page_limit, prefetch=prefetch):
+        for product in page['data']:
+            yield product
+
+
+async def get_product_info(product_id):
+    method = f'products/{product_id}'
+    product_info = await moltin_aiorequests.make_get_request(method)
+    moltin_logger.debug(f'Got product «{product_id}» info')
+    return product_info
+
+
+async def get_file_info(file_id):
+    method = f'files/{file_id}'
+    file_info = await moltin_aiorequests.make_get_request(method)
+    moltin_logger.debug(f'Got file «{file_id}» info')
+    return file_info
+
+
+async def create_customer(customer_info):
+    payload = {'data': {'type': 'customer'}}
+    payload['data'].update(customer_info)
+    method = 'customers'
+    response = await moltin_aiorequests.make_post_request(method, method_headers=APP_JSON_HEADER, payload=payload)
+    moltin_logger.debug('Customer created')
+    return response
+
+
+async def update_customer_info(customer_id, customer_info):
+    payload = {'data': {'type': 'customer'}}
+    payload['data'].update(customer_info)
+    method = f'customers/{customer_id}'
+    response = await moltin_aiorequests.make_put_request(method, payload)
+    moltin_logger.debug('Customer info updated')
+    return response
+
+
+async def get_cart(cart_name):
+    mirror = await get_cart_mirror(cart_name)
+    moltin_logger.debug(f'Got «{cart_name}» cart')
+    return cart_mirror.collect_cart(cart_name, mirror)
+
+
+async def get_cart_items(cart_name):
+    cart_items = (await get_cart_mirror(cart_name))['items']
+    moltin_logger.debug(f'Got cart «{cart_name}» items')
+    return cart_items
+
+
+async def get_cart_mirror(cart_name):
+    mirror = await cart_mirror.async_get_cart_mirror(cart_name)
+    if mirror is None:
+        mirror = await fetch_cart_mirror(cart_name)
+    elif await cart_mirror.async_check_mirror_needs_reconcile(cart_name, mirror):
+        asyncio.ensure_future(reconcile_cart_mirror(cart_name, mirror['synced_at']))
+    return mirror
+
+
+async def fetch_cart_mirror(cart_name, synced_at=None):
+    method = f'carts/{cart_name}/items'
+    cart_items_response = await moltin_aiorequests.get_page(f'https://api.moltin.com/v2/{method}')
+    return await cart_mirror.async_save_cart_mirror_if_unchanged(cart_name, cart_items_response, synced_at)
+
+
+async def reconcile_cart_mirror(cart_name, synced_at):
+    try:
+        await fetch_cart_mirror(cart_name, synced_at)
+    except Exception:
+        moltin_logger.exception(f'Cart «{cart_name}» mirror reconcile failed')
+
+
+async def add_product_to_cart(cart_name, product_id, quantity):
+    method = f'carts/{cart_name}/items'
+    payload = {
+        'data': {
+            'id': product_id,
+            'type': 'cart_item',
+            'quantity': quantity,
+
+        }
+    }
+    response = await moltin_aiorequests.make_post_request(method, method_headers=APP_JSON_HEADER, payload=payload)
+    await cart_mirror.async_save_cart_mirror(cart_name, response)
+    moltin_logger.debug(f'Product was added to «{cart_name}» cart')
+
+
+async def remove_item_from_cart(cart_name, item_id):
+    method = f'carts/{cart_name}/items/{item_id}'
+    status, content = await moltin_aiorequests.make_delete_request(method)
+    response = json.loads(content)
+    await cart_mirror.async_save_cart_mirror(cart_name, response)
+    moltin_logger.debug(f'Item {item_id} was deleted from cart')
+    return response
+
+
+async def delete_cart(cart_name):
+    method = f'carts/{cart_name}'
+    status, content = await moltin_aiorequests.make_delete_request(method)
+    await cart_mirror.async_delete_cart_mirror(cart_name)
+    moltin_logger.debug(f'Cart «{cart_name}» was deleted. Response code is: {status}')
+    return status == 204
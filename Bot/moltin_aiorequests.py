@@ -0,0 +1,151 @@
+import asyncio
+import json
+import logging
+import os
+
+import aiohttp
+
+import http_sessions
+import moltin_limiter
+import moltin_requests
+import moltin_token
+
+
+moltin_logger = logging.getLogger('moltin_loger')
+
+_session = None
+_in_flight_requests = {}
+
+PAGE_LIMIT = int(os.getenv('MOLTIN_PAGE_LIMIT', 100))
+
+
+def get_session():
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=http_sessions.POOL_SIZE, keepalive_timeout=30)
+        timeout = aiohttp.ClientTimeout(total=http_sessions.TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        moltin_logger.debug('Got new moltin aiohttp session')
+    return _session
+
+
+async def close_session():
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+
+async def make_get_request(method, payload=None):
+    return (await get_coalesced_page(f'https://api.moltin.com/v2/{method}', payload))['data']
+
+
+async def get_coalesced_page(url, payload=None):
+    '''
+    Async version of moltin_requests.get_coalesced_page. Cancelled caller
+    does not cancel the request for the others.
+    '''
+    key = moltin_requests.collect_request_key(url, payload)
+    request = _in_flight_requests.get(key)
+    if request is None:
+        request = _in_flight_requests[key] = asyncio.ensure_future(get_page(url, payload))
+        request.add_done_callback(lambda done_request: forget_request(key, done_request))
+    return await asyncio.shield(request)
+
+
+def forget_request(key, request):
+    if _in_flight_requests.get(key) is request:
+        del _in_flight_requests[key]
+
+
+async def get_page(url, payload=None):
+    '''
+    Async version of moltin_requests.get_page, shares its ETag pages.
+    '''
+    key = moltin_requests.collect_request_key(url, payload)
+    headers = await collect_authorization_header()
+    cached_page = moltin_requests.get_etag_page(key)
+    if cached_page:
+        headers['If-None-Match'] = cached_page['etag']
+    response, content = await send_request('GET', url, params=payload, headers=headers)
+    if response.status == 304 and cached_page:
+        moltin_logger.debug(f'GET request {url} was sent to moltin. Page is not modified')
+        return cached_page['page']
+    page = json.loads(content)
+    moltin_logger.debug('GET request %s was sent to moltin. Response is:\n%s', url, page)
+    moltin_requests.save_etag_page(key, response.headers.get('ETag'), page)
+    return page
+
+
+async def iterate_pages(method, payload=None, page_limit=PAGE_LIMIT, prefetch=False):
+    '''
+    Async version of moltin_requests.iterate_pages.
+    '''
+    payload = dict(payload or {})
+    payload['page[limit]'] = page_limit
+    page = await get_coalesced_page(f'https://api.moltin.com/v2/{method}', payload)
+    while True:
+        next_url = moltin_requests.get_next_page_url(page)
+        next_page = asyncio.ensure_future(get_coalesced_page(next_url)) if next_url and prefetch else None
+        yield page
+        if not next_url:
+            return
+        page = await next_page if next_page else await get_coalesced_page(next_url)
+
+
+async def send_request(http_method, url, **kwargs):
+    '''
+    Async version of moltin_requests.send_request, returns response and its content.
+    '''
+    priority = moltin_limiter.get_request_priority(url)
+    for attempt in range(moltin_limiter.MAX_RETRIES + 1):
+        await moltin_limiter.async_limiter.acquire(priority)
+        status, retry_after = None, None
+        try:
+            async with get_session().request(http_method, url, **kwargs) as response:
+                status = response.status
+                retry_after = moltin_limiter.get_retry_after(status, response.headers, attempt)
+                content = await response.read()
+        finally:
+            await moltin_limiter.async_limiter.release(status, retry_after)
+        if not moltin_limiter.check_request_can_be_retried(http_method, status):
+            break
+        moltin_logger.debug(f'{http_method} request {url} got {status} from moltin, attempt {attempt + 1}')
+    response.raise_for_status()
+    return response, content
+
+
+async def collect_authorization_header():
+    access_token = moltin_token.get_cached_access_token()
+    if access_token is None:
+        loop = asyncio.get_event_loop()
+        access_token = await loop.run_in_executor(None, moltin_token.get_access_token)
+    header = {
+        'Authorization': f'Bearer {access_token}',
+    }
+    return header
+
+
+async def make_post_request(method, method_headers={}, payload=None):
+    headers = await collect_authorization_header()
+    headers.update(method_headers)
+    response, content = await send_request('POST', f'https://api.moltin.com/v2/{method}', headers=headers,
+                                           json=payload)
+    response_json = json.loads(content)
+    moltin_logger.debug(f'POST request with method {method} was sent to moltin. Response is:\n{response_json}')
+    return response_json
+
+
+async def make_put_request(method, payload=None):
+    headers = await collect_authorization_header()
+    headers['Content-Type'] = 'application/json'
+    response, content = await send_request('PUT', f'https://api.moltin.com/v2/{method}', headers=headers,
+                                           json=payload)
+    response_json = json.loads(content)
+    moltin_logger.debug(f'PUT request with method {method} was sent to moltin. Response is:\n{response_json}')
+    return response_json
+
+
+async def make_delete_request(method):
+    headers = await collect_authorization_header()
+    response, content = await send_request('DELETE', f'https://api.moltin.com/v2/{method}', headers=headers)
+    moltin_logger.debug(f'DELETE request with method {method} was sent to moltin. Response is:\n{content}')
+    return response.status, content
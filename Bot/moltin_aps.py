@@ -1,26 +1,36 @@
+import hashlib
+import io
 import logging
-import os
+import threading
+from urllib.parse import urlparse
 
-import requests
 from slugify import slugify
 
+import cart_mirror
+import http_sessions
 import moltin_requests
 
 
 moltin_logger = logging.getLogger('moltin_loger')
 
 APP_JSON_HEADER = {'Content-Type': 'application/json'}
+IMAGE_CHUNK_SIZE = 64 * 1024
 
 
 def get_all_categories(sort=None):
-    method = f'categories?{sort}'
-    categories = moltin_requests.make_get_request(method)
+    categories = list(iterate_categories(sort))
     return categories
 
 
+def iterate_categories(sort=None, page_limit=moltin_requests.PAGE_LIMIT, prefetch=False):
+    method = f'categories?{sort}'
+    for page in moltin_requests.iterate_pages(method, page_limit=page_limit, prefetch=prefetch):
+        yield from page['data']
+
+
 def get_products_by_category_id(category_id, sort=None):
     method = f'products?filter=eq(category.id,{category_id})&{sort}'
-    products = moltin_requests.make_get_request(method)
+    products = [product for page in moltin_requests.iterate_pages(method) for product in page['data']]
     return products
 
 
@@ -39,11 +49,16 @@ def get_entry(flow_slug, entry_id):
 
 
 def get_all_entries(flow_slug):
-    method = f'flows/{flow_slug}/entries'
-    entries = moltin_requests.make_get_request(method)
+    entries = list(iterate_entries(flow_slug))
     return entries
 
 
+def iterate_entries(flow_slug, page_limit=moltin_requests.PAGE_LIMIT, prefetch=False):
+    method = f'flows/{flow_slug}/entries'
+    for page in moltin_requests.iterate_pages(method, page_limit=page_limit, prefetch=prefetch):
+        yield from page['data']
+
+
 def create_flow(flow_info, enabled=True):
     '''
     flow_info = {
@@ -109,6 +124,12 @@ def add_field_entry(entry_values, flow_slug):
 
 
 def create_product_and_add_image(product_id, product_name, description, img_url, price, currency='RUB'):
+    pizza_info = collect_pizza_info(product_id, product_name, description, price, currency)
+    product_id = create_product(pizza_info)['id']
+    add_product_image(product_id, img_url)
+
+
+def collect_pizza_info(product_id, product_name, description, price, currency='RUB'):
     sku = str(product_id)
     slugged_name = slugify(product_name)
     slug = f'{slugged_name}-{sku}'
@@ -126,24 +147,31 @@ def create_product_and_add_image(product_id, product_name, description, img_url,
         'status': 'live',
         'commodity_type': 'physical',
     }
-    product_id = create_product(pizza_info)['id']
-    image_path = download_image(img_url)
-    try:
-        image_id = create_file(image_path, 'true')['id']
-        add_product_main_image(product_id, image_id)
-    finally:
-        os.remove(image_path)
+    return pizza_info
 
 
-def download_image(url, folder='images'):
-    response = requests.get(url)
-    response.raise_for_status()
-    image_name = url.split('/')[-1]
-    os.makedirs(folder, exist_ok=True)
-    image_path = os.path.join(folder, image_name)
-    with open(image_path, 'wb') as new_file:
-        new_file.write(response.content)
-    return image_path
+def add_product_image(product_id, img_url):
+    image_name, image_file, _ = download_image(img_url)
+    image_id = create_file(image_name, image_file, 'true')['id']
+    add_product_main_image(product_id, image_id)
+
+
+def download_image(url):
+    '''
+    Image is read by chunks to memory and hashed on the way, nothing is written to disk.
+    Returns image name, file object and sha256 of image content.
+    '''
+    session = http_sessions.get_session(urlparse(url).netloc)
+    image_file = io.BytesIO()
+    content_hash = hashlib.sha256()
+    with session.get(url, stream=True, timeout=http_sessions.TIMEOUT) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(IMAGE_CHUNK_SIZE):
+            image_file.write(chunk)
+            content_hash.update(chunk)
+    image_file.seek(0)
+    image_name = urlparse(url).path.split('/')[-1]
+    return image_name, image_file, content_hash.hexdigest()
 
 
 def create_product(product_info):
@@ -155,14 +183,13 @@ def create_product(product_info):
     return product_info
 
 
-def create_file(filepath, public_status):
+def create_file(file_name, file, public_status):
     method = 'files'
-    with open(filepath, 'rb') as file:
-        files = {
-            'file': (filepath, file),
-            'public': (None, public_status),
-        }
-        file_info = moltin_requests.make_post_request(method, files=files)['data']
+    files = {
+        'file': (file_name, file),
+        'public': (None, public_status),
+    }
+    file_info = moltin_requests.make_post_request(method, files=files)['data']
     moltin_logger.debug('File created')
     return file_info
 
@@ -179,13 +206,17 @@ def add_product_main_image(product_id, image_id):
 
 
 def get_all_products():
-    method = 'products'
-    # TODO Paginaton
-    products = moltin_requests.make_get_request(method)
+    products = list(iterate_products())
     moltin_logger.debug('Got all products')
     return products
 
 
+def iterate_products(page_limit=moltin_requests.PAGE_LIMIT, prefetch=False):
+    method = 'products'
+    for page in moltin_requests.iterate_pages(method, page_limit=page_limit, prefetch=prefetch):
+        yield from page['data']
+
+
 def get_product_info(product_id):
     method = f'products/{product_id}'
     product_info = moltin_requests.make_get_request(method)
@@ -219,19 +250,39 @@ def update_customer_info(customer_id, customer_info):
 
 
 def get_cart(cart_name):
-    method = f'carts/{cart_name}'
-    cart = moltin_requests.make_get_request(method)
+    mirror = get_cart_mirror(cart_name)
     moltin_logger.debug(f'Got «{cart_name}» cart')
-    return cart
+    return cart_mirror.collect_cart(cart_name, mirror)
 
 
 def get_cart_items(cart_name):
-    method = f'carts/{cart_name}/items'
-    cart_items = moltin_requests.make_get_request(method)
+    cart_items = get_cart_mirror(cart_name)['items']
     moltin_logger.debug(f'Got cart «{cart_name}» items')
     return cart_items
 
 
+def get_cart_mirror(cart_name):
+    mirror = cart_mirror.get_cart_mirror(cart_name)
+    if mirror is None:
+        mirror = fetch_cart_mirror(cart_name)
+    elif cart_mirror.check_mirror_needs_reconcile(cart_name, mirror):
+        threading.Thread(target=reconcile_cart_mirror, args=(cart_name, mirror['synced_at']), daemon=True).start()
+    return mirror
+
+
+def fetch_cart_mirror(cart_name, synced_at=None):
+    method = f'carts/{cart_name}/items'
+    cart_items_response = moltin_requests.get_page(f'https://api.moltin.com/v2/{method}')
+    return cart_mirror.save_cart_mirror_if_unchanged(cart_name, cart_items_response, synced_at)
+
+
+def reconcile_cart_mirror(cart_name, synced_at):
+    try:
+        fetch_cart_mirror(cart_name, synced_at)
+    except Exception:
+        moltin_logger.exception(f'Cart «{cart_name}» mirror reconcile failed')
+
+
 def add_product_to_cart(cart_name, product_id, quantity):
     method = f'carts/{cart_name}/items'
     payload = {
@@ -242,13 +293,15 @@ def add_product_to_cart(cart_name, product_id, quantity):
 
         }
     }
-    moltin_requests.make_post_request(method, method_headers=APP_JSON_HEADER, payload=payload)
+    response = moltin_requests.make_post_request(method, method_headers=APP_JSON_HEADER, payload=payload)
+    cart_mirror.save_cart_mirror(cart_name, response)
     moltin_logger.debug(f'Product was added to «{cart_name}» cart')
 
 
 def remove_item_from_cart(cart_name, item_id):
     method = f'carts/{cart_name}/items/{item_id}'
     response = moltin_requests.make_delete_request(method).json()
+    cart_mirror.save_cart_mirror(cart_name, response)
     moltin_logger.debug(f'Item {item_id} was deleted from cart')
     return response
 
@@ -256,5 +309,6 @@ def remove_item_from_cart(cart_name, item_id):
 def delete_cart(cart_name):
     method = f'carts/{cart_name}'
     response = moltin_requests.make_delete_request(method)
+    cart_mirror.delete_cart_mirror(cart_name)
     moltin_logger.debug(f'Cart «{cart_name}» was deleted. Response code is: {response.status_code}')
     return response.status_code == 204
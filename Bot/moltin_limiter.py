@@ -0,0 +1,200 @@
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+
+
+CHECKOUT_PRIORITY = 0
+BROWSING_PRIORITY = 1
+CHECKOUT_METHODS = ('carts', 'flows', 'customers', 'orders')
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+
+RATE_LIMIT = float(os.getenv('MOLTIN_RATE_LIMIT', 20))
+BURST = int(os.getenv('MOLTIN_BURST', 20))
+MAX_CONCURRENCY = int(os.getenv('MOLTIN_MAX_CONCURRENCY', 16))
+MAX_RETRIES = int(os.getenv('MOLTIN_MAX_RETRIES', 3))
+DEFAULT_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 30
+
+
+def get_request_priority(method):
+    '''
+    Checkout requests (carts, flow entries, customers) go before browsing requests (catalog, files).
+    '''
+    method = method.split('api.moltin.com/', 1)[-1]
+    if method.startswith('v2/'):
+        method = method[len('v2/'):]
+    return CHECKOUT_PRIORITY if method.startswith(CHECKOUT_METHODS) else BROWSING_PRIORITY
+
+
+def check_status_is_overload(status):
+    return status is None or status == 429 or status >= 500
+
+
+def get_retry_after(status, headers, attempt=0):
+    '''
+    Seconds to pause requests after 429 or 5xx: Retry-After of the response or exponential
+    backoff with jitter, so requests retried together don't come back to moltin at once.
+    '''
+    if status is None or not check_status_is_overload(status):
+        return None
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return get_backoff_delay(attempt)
+
+
+def get_backoff_delay(attempt):
+    delay = min(MAX_RETRY_AFTER, DEFAULT_RETRY_AFTER * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def check_request_can_be_retried(http_method, status):
+    '''
+    429 means moltin did not handle request at all, 5xx is retried only for idempotent methods.
+    '''
+    if status == 429:
+        return True
+    return http_method in IDEMPOTENT_METHODS and check_status_is_overload(status)
+
+
+class RequestLimiter:
+    '''
+    Token bucket limits requests rate, adaptive window limits requests in flight:
+    the window grows by one request per window of successful responses and halves
+    on 429, 5xx and failed requests. Waiting requests go by priority, then by arrival.
+    '''
+
+    def __init__(self, rate=RATE_LIMIT, burst=BURST, max_concurrency=MAX_CONCURRENCY):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0
+        self.max_concurrency = max_concurrency
+        self.window = max_concurrency
+        self.in_flight = 0
+        self.waiters = []
+        self.counter = itertools.count()
+
+    def add_waiter(self, priority):
+        ticket = (priority, next(self.counter))
+        heapq.heappush(self.waiters, ticket)
+        return ticket
+
+    def get_wait_time(self, ticket):
+        '''
+        0 if request may be sent now, seconds to wait for a token, or None to wait for a release.
+        '''
+        if self.waiters[0] != ticket or self.in_flight >= int(self.window):
+            return None
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        return 0
+
+    def remove_waiter(self, ticket):
+        self.waiters.remove(ticket)
+        heapq.heapify(self.waiters)
+
+    def take(self):
+        heapq.heappop(self.waiters)
+        self.tokens -= 1
+        self.in_flight += 1
+
+    def finish(self, status, retry_after=None):
+        self.in_flight -= 1
+        if check_status_is_overload(status):
+            self.window = max(1, self.window / 2)
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        else:
+            self.window = min(self.max_concurrency, self.window + 1 / self.window)
+
+
+class ThreadRequestLimiter(RequestLimiter):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.condition = threading.Condition()
+
+    def acquire(self, priority):
+        with self.condition:
+            ticket = self.add_waiter(priority)
+            try:
+                wait_time = self.get_wait_time(ticket)
+                while wait_time != 0:
+                    self.condition.wait(wait_time)
+                    wait_time = self.get_wait_time(ticket)
+            except BaseException:
+                # ticket left at the head of waiters would block every next request
+                self.remove_waiter(ticket)
+                self.condition.notify_all()
+                raise
+            self.take()
+            self.condition.notify_all()
+
+    def release(self, status, retry_after=None):
+        with self.condition:
+            self.finish(status, retry_after)
+            self.condition.notify_all()
+
+
+class AsyncRequestLimiter(RequestLimiter):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.condition = None
+
+    async def acquire(self, priority):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            ticket = self.add_waiter(priority)
+            try:
+                wait_time = self.get_wait_time(ticket)
+                while wait_time != 0:
+                    await self.wait(wait_time)
+                    wait_time = self.get_wait_time(ticket)
+            except BaseException:
+                # cancelled request must not block every next request
+                self.remove_waiter(ticket)
+                self.condition.notify_all()
+                raise
+            self.take()
+            self.condition.notify_all()
+
+    async def wait(self, wait_time):
+        '''
+        Condition.wait with timeout. Unlike asyncio.wait_for it holds the lock again
+        when the waiting task is cancelled.
+        '''
+        if wait_time is None:
+            await self.condition.wait()
+            return
+        loop = asyncio.get_event_loop()
+        wake_up = loop.call_later(wait_time, lambda: asyncio.ensure_future(self.notify_waiters()))
+        try:
+            await self.condition.wait()
+        finally:
+            wake_up.cancel()
+
+    async def notify_waiters(self):
+        async with self.condition:
+            self.condition.notify_all()
+
+    async def release(self, status, retry_after=None):
+        async with self.condition:
+            self.finish(status, retry_after)
+            self.condition.notify_all()
+
+
+limiter = ThreadRequestLimiter()
+async_limiter = AsyncRequestLimiter()
@@ -1,61 +1,169 @@
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
 import logging
 import os
+import threading
 
-import requests
+import http_sessions
+import moltin_limiter
+import moltin_token
 
 
 moltin_logger = logging.getLogger('moltin_loger')
 
-_access_token_info = None
+MOLTIN_HOST = 'api.moltin.com'
+PAGE_LIMIT = int(os.getenv('MOLTIN_PAGE_LIMIT', 100))
+ETAG_CACHE_SIZE = int(os.getenv('MOLTIN_ETAG_CACHE_SIZE', 1000))
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='moltin_prefetch')
+_in_flight_requests = {}
+_in_flight_lock = threading.Lock()
+_etag_pages = OrderedDict()
+_etag_pages_lock = threading.Lock()
 
 
 def make_get_request(method, payload=None):
+    return get_coalesced_page(f'https://api.moltin.com/v2/{method}', payload)['data']
+
+
+def get_coalesced_page(url, payload=None):
+    '''
+    Concurrent callers of the same url with the same params share one request and its result.
+    '''
+    key = collect_request_key(url, payload)
+    with _in_flight_lock:
+        request = _in_flight_requests.get(key)
+        is_first = request is None
+        if is_first:
+            request = _in_flight_requests[key] = {'done': threading.Event()}
+    if not is_first:
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['page']
+    try:
+        request['page'] = get_page(url, payload)
+    except Exception as error:
+        request['error'] = error
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight_requests[key]
+        request['done'].set()
+    return request['page']
+
+
+def collect_request_key(url, payload=None):
+    return json.dumps([url, payload], sort_keys=True, default=str)
+
+
+def get_page(url, payload=None):
+    '''
+    Pages with ETag are kept in process memory and revalidated, so unchanged page costs 304 and no parsing.
+    '''
+    key = collect_request_key(url, payload)
     headers = collect_authorization_header()
-    response = requests.get(f'https://api.moltin.com/v2/{method}', params=payload, headers=headers)
+    cached_page = get_etag_page(key)
+    if cached_page:
+        headers['If-None-Match'] = cached_page['etag']
+    response = send_request('GET', url, params=payload, headers=headers)
+    if response.status_code == 304 and cached_page:
+        moltin_logger.debug(f'GET request {url} was sent to moltin. Page is not modified')
+        return cached_page['page']
+    page = response.json()
+    moltin_logger.debug('GET request %s was sent to moltin. Response is:\n%s', url, page)
+    save_etag_page(key, response.headers.get('ETag'), page)
+    return page
+
+
+def get_etag_page(key):
+    with _etag_pages_lock:
+        cached_page = _etag_pages.get(key)
+        if cached_page:
+            _etag_pages.move_to_end(key)
+    return cached_page
+
+
+def save_etag_page(key, etag, page):
+    if not etag:
+        return
+    with _etag_pages_lock:
+        _etag_pages[key] = {'etag': etag, 'page': page}
+        _etag_pages.move_to_end(key)
+        if len(_etag_pages) > ETAG_CACHE_SIZE:
+            _etag_pages.popitem(last=False)
+
+
+def iterate_pages(method, payload=None, page_limit=PAGE_LIMIT, prefetch=False):
+    '''
+    Yield moltin response pages one by one following `links.next`.
+    Every page is coalesced with concurrent requests of the same page.
+    With prefetch the next page is requested while the current one is processed.
+    '''
+    payload = dict(payload or {})
+    payload['page[limit]'] = page_limit
+    page = get_coalesced_page(f'https://api.moltin.com/v2/{method}', payload)
+    while True:
+        next_url = get_next_page_url(page)
+        next_page = _prefetch_executor.submit(get_coalesced_page, next_url) if next_url and prefetch else None
+        yield page
+        if not next_url:
+            return
+        page = next_page.result() if next_page else get_coalesced_page(next_url)
+
+
+def get_next_page_url(page):
+    '''
+    Moltin may return fewer entries than page[limit] asked for, so a short page is not
+    a sign of the last one: the last page has no next link or is the last by page meta.
+    '''
+    links = page.get('links') or {}
+    next_url = links.get('next')
+    if not next_url or next_url == links.get('current'):
+        return None
+    page_meta = (page.get('meta') or {}).get('page') or {}
+    if page_meta.get('current') and page_meta.get('total') and page_meta['current'] >= page_meta['total']:
+        return None
+    return next_url
+
+
+def send_request(http_method, url, **kwargs):
+    '''
+    All moltin requests of the process share one limiter. Requests rejected
+    because of overload are sent again, unless they upload files.
+    '''
+    priority = moltin_limiter.get_request_priority(url)
+    session = http_sessions.get_session(MOLTIN_HOST)
+    retries = 0 if kwargs.get('files') else moltin_limiter.MAX_RETRIES
+    for attempt in range(retries + 1):
+        moltin_limiter.limiter.acquire(priority)
+        status, retry_after = None, None
+        try:
+            response = session.request(http_method, url, timeout=http_sessions.TIMEOUT, **kwargs)
+            status = response.status_code
+            retry_after = moltin_limiter.get_retry_after(status, response.headers, attempt)
+        finally:
+            moltin_limiter.limiter.release(status, retry_after)
+        if not moltin_limiter.check_request_can_be_retried(http_method, status):
+            break
+        moltin_logger.debug(f'{http_method} request {url} got {status} from moltin, attempt {attempt + 1}')
     response.raise_for_status()
-    moltin_logger.debug(f'GET request with method {method} was sent to moltin. Response is:\n{response.json()}')
-    return response.json()['data']
+    return response
 
 
 def collect_authorization_header():
-    global _access_token_info
-    if not _access_token_info or check_for_token_expired(_access_token_info['expires']):
-        _access_token_info = get_access_token_info()
-
-    access_token = _access_token_info['access_token']
+    access_token = moltin_token.get_access_token()
     header = {
         'Authorization': f'Bearer {access_token}',
     }
     return header
 
 
-def get_access_token_info():
-    client_id = os.environ['MOLT_CLIENT_ID']
-    client_secret = os.environ['MOLT_CLIENT_SECRET']
-    payload = {
-        'client_id': f'{client_id}',
-        'client_secret': f'{client_secret}',
-        'grant_type': 'client_credentials'
-    }
-    response = requests.post('https://api.moltin.com/oauth/access_token', data=payload)
-    response.raise_for_status()
-    moltin_logger.debug('Got moltin access token')
-    return response.json()
-
-
-def check_for_token_expired(token_expires):
-    request_time_reserve = 10
-    token_expires = token_expires - request_time_reserve
-    now_time = int(datetime.now().timestamp())
-    return now_time >= token_expires
-
-
 def make_post_request(method, method_headers={}, payload=None, files=None):
     headers = collect_authorization_header()
     headers.update(method_headers)
-    response = requests.post(f'https://api.moltin.com/v2/{method}', headers=headers, json=payload, files=files)
-    response.raise_for_status()
+    response = send_request('POST', f'https://api.moltin.com/v2/{method}', headers=headers, json=payload, files=files)
     moltin_logger.debug(f'POST request with method {method} was sent to moltin. Response is:\n{response.json()}')
     return response.json()
 
@@ -63,15 +171,13 @@ def make_post_request(method, method_headers={}, payload=None, files=None):
 def make_put_request(method, payload=None):
     headers = collect_authorization_header()
     headers['Content-Type'] = 'application/json'
-    response = requests.put(f'https://api.moltin.com/v2/{method}', headers=headers, json=payload)
-    response.raise_for_status()
+    response = send_request('PUT', f'https://api.moltin.com/v2/{method}', headers=headers, json=payload)
     moltin_logger.debug(f'PUT request with method {method} was sent to moltin. Response is:\n{response.json()}')
     return response.json()
 
 
 def make_delete_request(method):
     headers = collect_authorization_header()
-    response = requests.delete(f'https://api.moltin.com/v2/{method}', headers=headers)
-    response.raise_for_status()
+    response = send_request('DELETE', f'https://api.moltin.com/v2/{method}', headers=headers)
     moltin_logger.debug(f'DELETE request with method {method} was sent to moltin. Response is:\n{response.content}')
     return response
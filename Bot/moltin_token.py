@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import http_sessions
+
+
+moltin_logger = logging.getLogger('moltin_loger')
+
+TOKEN_KEY = 'moltin_access_token'
+TOKEN_LOCK_KEY = 'moltin_access_token:refreshing'
+REFRESH_MARGIN = int(os.getenv('MOLTIN_TOKEN_REFRESH_MARGIN', 300))
+REFRESH_LOCK_TIMEOUT = 30
+REQUEST_TIME_RESERVE = 10
+
+_access_token_info = None
+_refresh_lock = threading.Lock()
+_refresher_pid = None
+
+
+def get_access_token():
+    '''
+    Access token from process memory. It is refreshed in background before expiry,
+    so requests wait for moltin only on cold start.
+    '''
+    access_token = get_cached_access_token()
+    if access_token is None:
+        access_token = refresh_access_token()['access_token']
+    return access_token
+
+
+def get_cached_access_token():
+    '''
+    Access token from process memory or None if it is not there yet, never waits.
+    '''
+    start_token_refresher()
+    token_info = _access_token_info
+    if token_info is None or check_for_token_expired(token_info['expires'], REQUEST_TIME_RESERVE):
+        return None
+    return token_info['access_token']
+
+
+def refresh_access_token(force=False):
+    '''
+    One refresh per process at a time, and one refresh per moltin store across
+    all processes: the rest take the token saved to db by the refreshing one.
+    '''
+    global _access_token_info
+    with _refresh_lock:
+        token_info = get_saved_token_info()
+        margin = REFRESH_MARGIN if force else REQUEST_TIME_RESERVE
+        while token_info is None or check_for_token_expired(token_info['expires'], margin):
+            lock_token = get_db_aps().acquire_lock(TOKEN_LOCK_KEY, REFRESH_LOCK_TIMEOUT, blocking=False)
+            if lock_token is not None:
+                try:
+                    token_info = get_access_token_info()
+                    save_token_info(token_info)
+                finally:
+                    get_db_aps().release_lock(TOKEN_LOCK_KEY, lock_token)
+                break
+            time.sleep(0.1)
+            token_info = get_saved_token_info()
+        _access_token_info = token_info
+    return token_info
+
+
+def get_db_aps():
+    # imported here as db_aps imports moltin_aps, which imports this module through moltin_requests
+    import db_aps
+    return db_aps
+
+
+def get_saved_token_info():
+    db = get_db_aps().get_database_connection()
+    token_info = db.get(TOKEN_KEY)
+    return json.loads(token_info) if token_info else None
+
+
+def save_token_info(token_info):
+    db = get_db_aps().get_database_connection()
+    expires_in = max(int(token_info['expires'] - time.time()), 1)
+    db.set(TOKEN_KEY, json.dumps(token_info), ex=expires_in)
+
+
+def get_access_token_info():
+    client_id = os.environ['MOLT_CLIENT_ID']
+    client_secret = os.environ['MOLT_CLIENT_SECRET']
+    payload = {
+        'client_id': f'{client_id}',
+        'client_secret': f'{client_secret}',
+        'grant_type': 'client_credentials'
+    }
+    session = http_sessions.get_session('api.moltin.com')
+    response = session.post('https://api.moltin.com/oauth/access_token', data=payload, timeout=http_sessions.TIMEOUT)
+    response.raise_for_status()
+    moltin_logger.debug('Got moltin access token')
+    return response.json()
+
+
+def check_for_token_expired(token_expires, time_reserve):
+    return time.time() >= token_expires - time_reserve
+
+
+def start_token_refresher():
+    '''
+    Start refresher thread once per process, including forked gunicorn workers.
+    '''
+    global _refresher_pid
+    if _refresher_pid == os.getpid():
+        return
+    with _refresh_lock:
+        if _refresher_pid == os.getpid():
+            return
+        threading.Thread(target=refresh_token_periodically, name='moltin_token_refresher', daemon=True).start()
+        _refresher_pid = os.getpid()
+
+
+def refresh_token_periodically():
+    while True:
+        token_info = _access_token_info
+        if token_info is not None:
+            time.sleep(max(token_info['expires'] - REFRESH_MARGIN - time.time(), 1))
+        try:
+            refresh_access_token(force=True)
+        except Exception:
+            moltin_logger.exception('Moltin access token refresh failed')
+            time.sleep(5)
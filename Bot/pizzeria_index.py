@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import os
+import time
+
+from geopy.distance import distance
+import numpy as np
+
+import db_aps
+import moltin_aioaps
+import moltin_aps
+
+
+index_logger = logging.getLogger('index_logger')
+
+PIZZERIAS_VERSION_KEY = 'pizzerias_version'
+INDEX_TTL = int(os.getenv('PIZZERIA_INDEX_TTL', 3600))
+VERSION_CHECK_INTERVAL = int(os.getenv('PIZZERIA_INDEX_VERSION_CHECK_INTERVAL', 5))
+
+EARTH_RADIUS = 6371.0088
+# Haversine with the mean radius differs from geodesic distance on WGS-84 by at most
+# EARTH_RADIUS / 6335.439 - 1 ≈ 0.56% (6335.439 km is the meridional radius at the equator,
+# the smallest WGS-84 radius of curvature), so the bound is rounded up to 0.6%
+HAVERSINE_ERROR = 0.006
+
+_index = {
+    'version': None,
+    'expires': 0,
+    'index': None,
+}
+_current_version = {
+    'version': None,
+    'checked': 0,
+}
+_refresh_lock = None
+
+
+class PizzeriaIndex:
+
+    def __init__(self, pizzerias, version=None):
+        self.version = version
+        self.pizzerias = pizzerias
+        self.pizzerias_by_id = {pizzeria['id']: pizzeria for pizzeria in pizzerias}
+        coords = np.array([(pizzeria['latitude'], pizzeria['longitude']) for pizzeria in pizzerias], dtype=float)
+        coords = np.radians(coords.reshape(-1, 2))
+        self.lats = coords[:, 0]
+        self.lons = coords[:, 1]
+        self.cos_lats = np.cos(self.lats)
+
+    def __len__(self):
+        return len(self.pizzerias)
+
+    def get_haversine_distances(self, coords):
+        lat, lon = np.radians(coords)
+        hav = (np.sin((self.lats - lat) / 2) ** 2
+               + np.cos(lat) * self.cos_lats * np.sin((self.lons - lon) / 2) ** 2)
+        return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(hav, 1)))
+
+    def find_nearest(self, coords):
+        '''
+        Nearest pizzeria with exact geodesic `distance` in kilometers.
+        Geodesic distance is computed only for pizzerias whose haversine distance
+        is within the haversine error from the minimal one.
+        '''
+        haversine_distances = self.get_haversine_distances(coords)
+        threshold = haversine_distances.min() * (1 + HAVERSINE_ERROR) / (1 - HAVERSINE_ERROR)
+        candidates = np.flatnonzero(haversine_distances <= threshold)
+        nearest_pizzeria = None
+        for candidate in candidates:
+            pizzeria = self.pizzerias[candidate]
+            pizzeria_coords = (pizzeria['latitude'], pizzeria['longitude'])
+            pizzeria_distance = distance(coords, pizzeria_coords).kilometers
+            if nearest_pizzeria is None or pizzeria_distance < nearest_pizzeria['distance']:
+                nearest_pizzeria = dict(pizzeria, distance=pizzeria_distance)
+        return nearest_pizzeria
+
+
+def get_pizzerias_version():
+    db = db_aps.get_database_connection()
+    version = db.get(PIZZERIAS_VERSION_KEY)
+    return int(version) if version else 0
+
+
+async def async_get_pizzerias_version():
+    db = await db_aps.get_async_database_connection()
+    version = await db.get(PIZZERIAS_VERSION_KEY)
+    return int(version) if version else 0
+
+
+def invalidate_index():
+    db = db_aps.get_database_connection()
+    version = db.incr(PIZZERIAS_VERSION_KEY)
+    note_pizzerias_version(version)
+    index_logger.debug(f'Pizzerias version bumped to {version}')
+    return version
+
+
+def note_pizzerias_version(version):
+    '''
+    Save pizzerias version read from db, e.g. in the same pipeline with user state.
+    '''
+    _current_version.update({
+        'version': version,
+        'checked': time.monotonic(),
+    })
+
+
+def get_current_pizzerias_version():
+    if time.monotonic() - _current_version['checked'] >= VERSION_CHECK_INTERVAL:
+        note_pizzerias_version(get_pizzerias_version())
+    return _current_version['version']
+
+
+async def async_get_current_pizzerias_version():
+    if time.monotonic() - _current_version['checked'] >= VERSION_CHECK_INTERVAL:
+        note_pizzerias_version(await async_get_pizzerias_version())
+    return _current_version['version']
+
+
+def check_index_is_fresh(version):
+    if _index['index'] is None or time.monotonic() >= _index['expires']:
+        return False
+    return _index['version'] == version
+
+
+def save_index(version, pizzerias):
+    _index.update({
+        'version': version,
+        'expires': time.monotonic() + INDEX_TTL,
+        'index': PizzeriaIndex(pizzerias, version),
+    })
+    index_logger.debug(f'Pizzeria index version {version} was built with {len(pizzerias)} pizzerias')
+
+
+def get_index():
+    version = get_current_pizzerias_version()
+    if not check_index_is_fresh(version):
+        save_index(version, moltin_aps.get_all_entries('pizzeria'))
+    return _index['index']
+
+
+async def async_get_index():
+    global _refresh_lock
+    if _refresh_lock is None:
+        _refresh_lock = asyncio.Lock()
+    async with _refresh_lock:
+        version = await async_get_current_pizzerias_version()
+        if not check_index_is_fresh(version):
+            save_index(version, await moltin_aioaps.get_all_entries('pizzeria'))
+    return _index['index']
@@ -0,0 +1,59 @@
+import logging
+import os
+import time
+
+import db_aps
+
+
+jobs_logger = logging.getLogger('jobs_logger')
+
+JOBS_KEY = 'scheduled_jobs'
+RETRY_DELAY = float(os.getenv('SCHEDULED_JOBS_RETRY_DELAY', 60))
+JOB_LOCK_TIMEOUT = int(os.getenv('SCHEDULED_JOBS_LOCK_TIMEOUT', 600))
+CHECK_INTERVAL = 1
+
+
+def schedule_job(job_name, delay, pipeline=None):
+    '''
+    Run the job once `delay` seconds after the first scheduling: until it runs,
+    scheduling it again does not move the time, so a burst of events costs a single run.
+    Jobs are kept in db and run by the long-lived worker process, not by web workers.
+    '''
+    db = pipeline if pipeline is not None else db_aps.get_database_connection()
+    db.zadd(JOBS_KEY, {job_name: time.time() + delay}, nx=True)
+
+
+def run_due_jobs(jobs):
+    '''
+    Run due jobs from `jobs` (job name → function), one process at a time for each job.
+    Job is unscheduled before it runs, so events coming while it runs schedule it again.
+    Failed job is scheduled again after RETRY_DELAY.
+    '''
+    db = db_aps.get_database_connection()
+    for job_name in db.zrangebyscore(JOBS_KEY, '-inf', time.time()):
+        job_name = job_name.decode('utf-8')
+        job = jobs.get(job_name)
+        if job is None:
+            continue
+        lock_key = f'{JOBS_KEY}:{job_name}'
+        lock_token = db_aps.acquire_lock(lock_key, JOB_LOCK_TIMEOUT, blocking=False)
+        if lock_token is None:
+            continue
+        try:
+            db.zrem(JOBS_KEY, job_name)
+            job()
+            jobs_logger.debug(f'Job {job_name} was done')
+        except Exception:
+            jobs_logger.exception(f'Job {job_name} failed')
+            schedule_job(job_name, RETRY_DELAY)
+        finally:
+            db_aps.release_lock(lock_key, lock_token)
+
+
+def run_jobs_forever(jobs):
+    while True:
+        try:
+            run_due_jobs(jobs)
+        except Exception:
+            jobs_logger.exception('Scheduled jobs check failed')
+        time.sleep(CHECK_INTERVAL)
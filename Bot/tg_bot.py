@@ -1,16 +1,24 @@
-from asyncio import sleep
+import asyncio
 import logging
+import math
 import os
 from textwrap import dedent
 
 from aiogram import Bot, Dispatcher, executor, types
+from aiogram.dispatcher.webhook import get_new_configured_app
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.utils.exceptions import MessageCantBeDeleted
+from aiogram.utils.exceptions import MessageCantBeDeleted, WrongFileIdentifier
 from dotenv import load_dotenv
 
+import catalog_cache
+import chat_dispatcher
 import db_aps
+import delivery_zones
+import image_cache
 import log_config
-import moltin_aps
+import moltin_aioaps
+import moltin_aiorequests
+import pizzeria_index
 import utils
 
 
@@ -23,6 +31,14 @@ dp = Dispatcher(bot)
 
 CART_BUTTON = InlineKeyboardButton('Корзина', callback_data='cart')
 MENU_BUTTON = InlineKeyboardButton('Меню', callback_data='menu')
+PRODUCTS_ON_PAGE = 8
+WEBHOOK_PATH = os.getenv('TG_WEBHOOK_PATH', '/tg-webhook')
+
+_menu_keyboards = {
+    'catalog_version': None,
+    'products': None,
+    'pages': [],
+}
 
 
 def main():
@@ -31,7 +47,42 @@ def main():
         handlers=[log_config.SendToTelegramHandler()],
         level='ERROR',
     )
-    executor.start_polling(dp)
+    if os.getenv('TG_BOT_MODE', 'polling') == 'webhook':
+        executor.start_webhook(
+            dp, WEBHOOK_PATH, on_startup=on_startup, on_shutdown=on_shutdown,
+            host=os.getenv('TG_WEBHOOK_LISTEN_HOST', '0.0.0.0'), port=int(os.getenv('PORT', 8080)),
+        )
+    else:
+        executor.start_polling(dp, on_shutdown=on_shutdown)
+
+
+async def create_web_app():
+    '''
+    Webhook app factory for running bot in several processes:
+    gunicorn --chdir Bot tg_bot:create_web_app --worker-class aiohttp.GunicornWebWorker --workers 4
+    '''
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[log_config.SendToTelegramHandler()],
+        level='ERROR',
+    )
+    app = get_new_configured_app(dp, WEBHOOK_PATH)
+    app.on_startup.append(lambda app: on_startup(dp))
+    app.on_shutdown.append(lambda app: on_shutdown(dp))
+    return app
+
+
+async def on_startup(dispatcher):
+    webhook_url = f"{os.environ['TG_WEBHOOK_HOST']}{WEBHOOK_PATH}"
+    webhook_info = await bot.get_webhook_info()
+    if webhook_info.url != webhook_url:
+        await bot.set_webhook(webhook_url)
+        tg_logger.debug(f'Webhook was set to {webhook_url}')
+
+
+async def on_shutdown(dispatcher):
+    await moltin_aiorequests.close_session()
+    await db_aps.close_async_database_connection()
 
 
 @dp.errors_handler()
@@ -42,7 +93,8 @@ async def handle_errors(update, exception):
 
 @dp.callback_query_handler(lambda callback_query: True)
 async def handle_callback_query(callback_query: types.CallbackQuery):
-    await handle_user_reply(callback_query)
+    chat_id, user_reply = handle_update(callback_query)
+    await chat_dispatcher.dispatch(chat_id, callback_query, handle_user_reply)
 
 
 @dp.pre_checkout_query_handler(lambda query: True)
@@ -61,10 +113,16 @@ async def process_successful_payment(message: types.Message):
 
 
 @dp.message_handler(content_types=types.ContentTypes.ANY)
+async def handle_message(message: types.Message):
+    chat_id, user_reply = handle_update(message)
+    await chat_dispatcher.dispatch(chat_id, message, handle_user_reply)
+
+
 async def handle_user_reply(update):
-    db = db_aps.get_database_connection()
+    db = await db_aps.get_async_database_connection()
     chat_id, user_reply = handle_update(update)
-    user_state = get_user_state(chat_id, user_reply, db)
+    recorded_state = await read_update_context(chat_id, db)
+    user_state = await get_user_state(chat_id, user_reply, recorded_state)
     states_functions = {
         'START': handle_start,
         'HANDLE_MENU': handle_menu,
@@ -77,10 +135,28 @@ async def handle_user_reply(update):
 
     state_handler = states_functions[user_state]
     next_state = await state_handler(update)
-    db.set(chat_id, next_state)
+    # next state is known only after the handler, and it must be in db before the chat lock
+    # is released: the next update of the chat may be handled by another process
+    await db.set(chat_id, next_state)
     tg_logger.debug(f'User «{chat_id}» state changed to {next_state}')
 
 
+async def read_update_context(chat_id, db):
+    '''
+    Read user state together with catalog and pizzerias versions in one db round-trip,
+    so in-memory caches don't go to db on their own. Other round-trips of an update are
+    the chat lock with its renewals and release, the stale callback check and saving the next state.
+    '''
+    pipeline = db.pipeline()
+    recorded_state = pipeline.get(chat_id)
+    catalog_version = pipeline.get(catalog_cache.CATALOG_VERSION_KEY)
+    pizzerias_version = pipeline.get(pizzeria_index.PIZZERIAS_VERSION_KEY)
+    await pipeline.execute()
+    catalog_cache.note_catalog_version(int(catalog_version.result() or 0))
+    pizzeria_index.note_pizzerias_version(int(pizzerias_version.result() or 0))
+    return recorded_state.result()
+
+
 def handle_update(update):
     if type(update) == types.Message:
         chat_id = f'tg-{update.chat.id}'
@@ -91,14 +167,14 @@ def handle_update(update):
     return chat_id, user_reply
 
 
-def get_user_state(chat_id, user_reply, db):
+async def get_user_state(chat_id, user_reply, recorded_state):
     if user_reply == '/start':
         user_state = 'START'
     elif user_reply == '/cancel':
         user_state = 'START'
-        moltin_aps.delete_cart(chat_id)
+        await moltin_aioaps.delete_cart(chat_id)
     else:
-        user_state = db.get(chat_id).decode('utf-8')
+        user_state = recorded_state.decode('utf-8')
     return user_state
 
 
@@ -114,10 +190,27 @@ async def send_menu(message: types.Message, page_number):
 
 
 async def collect_menu_keyboard(page_number):
-    prod_on_page = 8
-    first_product_num = page_number * prod_on_page
-    last_product_num = first_product_num + prod_on_page
-    products = moltin_aps.get_all_products()
+    '''
+    Serialized menu page keyboard. All pages are built once per catalog version.
+    '''
+    products = await catalog_cache.get_all_products()
+    catalog_version = catalog_cache.get_loaded_catalog_version()
+    if _menu_keyboards['catalog_version'] != catalog_version or _menu_keyboards['products'] is not products:
+        pages_count = max(math.ceil(len(products) / PRODUCTS_ON_PAGE), 1)
+        _menu_keyboards.update({
+            'catalog_version': catalog_version,
+            'products': products,
+            'pages': [build_menu_keyboard(products, page).as_json() for page in range(pages_count)],
+        })
+        tg_logger.debug(f'Menu keyboards for catalog version {catalog_version} were collected')
+    if page_number < len(_menu_keyboards['pages']):
+        return _menu_keyboards['pages'][page_number]
+    return build_menu_keyboard(products, page_number).as_json()
+
+
+def build_menu_keyboard(products, page_number):
+    first_product_num = page_number * PRODUCTS_ON_PAGE
+    last_product_num = first_product_num + PRODUCTS_ON_PAGE
 
     keyboard = InlineKeyboardMarkup(row_width=2)
     for product in products[first_product_num:last_product_num]:
@@ -130,7 +223,6 @@ async def collect_menu_keyboard(page_number):
     if last_product_num < len(products) and page_number == 0:
         keyboard.add(InlineKeyboardButton('След. стр. →', callback_data=f'pagination,{page_number+1}'))
     keyboard.add(CART_BUTTON)
-    tg_logger.debug('Menu keyboard was collected')
     return keyboard
 
 
@@ -147,9 +239,8 @@ async def handle_menu(callback_query: types.CallbackQuery):
         await delete_bot_message(callback_query)
         return 'HANDLE_MENU'
 
-    product_info = moltin_aps.get_product_info(callback_query.data)
+    product_info = await catalog_cache.get_product_info(callback_query.data)
     image_id = product_info['relationships']['main_image']['data']['id']
-    image_url = moltin_aps.get_file_info(image_id)['link']['href']
     product_name = product_info['name']
     text = dedent(f'''\
     {product_name}\n
@@ -159,17 +250,34 @@ async def handle_menu(callback_query: types.CallbackQuery):
     keyboard = await collect_product_description_keyboard(callback_query.data)
 
     await callback_query.answer(text=product_name)
-    await bot.send_photo(callback_query.message.chat.id, image_url, caption=text, reply_markup=keyboard)
+    await send_product_photo(callback_query.message.chat.id, callback_query.data, image_id, text, keyboard)
     await delete_bot_message(callback_query)
     return 'HANDLE_DESCRIPTION'
     tg_logger.debug(f'{product_name} description was sent')
 
 
+async def send_product_photo(chat_id, product_id, image_id, caption, keyboard):
+    '''
+    Send photo by telegram file_id saved on the first send, so telegram doesn't refetch the image.
+    '''
+    file_id = await image_cache.async_get_telegram_file_id(product_id, image_id)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id, file_id, caption=caption, reply_markup=keyboard)
+        except WrongFileIdentifier:
+            tg_logger.debug(f'Telegram file_id of product «{product_id}» photo is outdated')
+
+    image_url = await image_cache.async_get_image_url(image_id)
+    message = await bot.send_photo(chat_id, image_url, caption=caption, reply_markup=keyboard)
+    await image_cache.async_save_telegram_file_id(product_id, image_id, message.photo[-1].file_id)
+    return message
+
+
 async def send_cart(callback_query):
     keyboard = InlineKeyboardMarkup(row_width=2).add(MENU_BUTTON)
     cart_name = f'tg-{callback_query.message.chat.id}'
     chat_id = callback_query.message.chat.id
-    cart_items = moltin_aps.get_cart_items(cart_name)
+    cart_items = await moltin_aioaps.get_cart_items(cart_name)
     if not cart_items:
         text = 'Ваша корзина пуста.'
         tg_logger.debug(f'Got empty cart for {chat_id}')
@@ -183,7 +291,7 @@ async def send_cart(callback_query):
 
 async def collect_full_cart(cart_items, cart_name, keyboard):
     text = 'Товары в вашей корзине:\n\n'
-    total_price = moltin_aps.get_cart(cart_name)['meta']['display_price']['with_tax']['formatted']
+    total_price = (await moltin_aioaps.get_cart(cart_name))['meta']['display_price']['with_tax']['formatted']
     for item in cart_items:
         product_name = item['name']
         item_id = item['id']
@@ -234,7 +342,7 @@ async def handle_description(callback_query: types.CallbackQuery):
         return 'HANDLE_CART'
     else:
         product_id, number_of_kilos = callback_query.data.split(',')
-        moltin_aps.add_product_to_cart(f'tg-{callback_query.message.chat.id}', product_id, int(number_of_kilos))
+        await moltin_aioaps.add_product_to_cart(f'tg-{callback_query.message.chat.id}', product_id, int(number_of_kilos))
         await callback_query.answer(f'{number_of_kilos} шт. добавлено в корзину')
         return 'HANDLE_DESCRIPTION'
 
@@ -254,7 +362,7 @@ async def handle_cart(callback_query: types.CallbackQuery):
         tg_logger.debug('Start payment conversation')
         return 'WAITING_ADDRESS'
     else:
-        moltin_aps.remove_item_from_cart(f'tg-{callback_query.message.chat.id}', callback_query.data)
+        await moltin_aioaps.remove_item_from_cart(f'tg-{callback_query.message.chat.id}', callback_query.data)
         await send_cart(callback_query)
         await delete_bot_message(callback_query)
     return 'HANDLE_CART'
@@ -267,7 +375,8 @@ async def handle_address(message: types.Message):
 
     if message.text:
         apikey = os.environ['GEOCODER_KEY']
-        lat, lon = utils.fetch_coordinates(apikey, message.text)
+        loop = asyncio.get_event_loop()
+        lat, lon = await loop.run_in_executor(None, utils.fetch_coordinates, apikey, message.text)
     elif message.location:
         lat = message.location.latitude
         lon = message.location.longitude
@@ -277,8 +386,9 @@ async def handle_address(message: types.Message):
             'latitude': lat,
             'longitude': lon,
         }
-        coords_id = moltin_aps.add_field_entry(customer_address_entry, 'customer-address')['id']
-        answer, delivery_allowed, nearest_pizzeria_id, delivery_price = get_answer_by_customer_coords(customer_coords)
+        coords_id = (await moltin_aioaps.add_field_entry(customer_address_entry, 'customer-address'))['id']
+        index = await pizzeria_index.async_get_index()
+        answer, delivery_allowed, nearest_pizzeria_id, delivery_price = await get_answer_by_customer_coords(customer_coords, index)
         address_keyboard = collect_address_keyboard(coords_id, nearest_pizzeria_id, delivery_allowed, delivery_price)
 
     await bot.send_message(message.chat.id, answer, reply_markup=address_keyboard)
@@ -287,23 +397,23 @@ async def handle_address(message: types.Message):
     return 'WAITING_DELIVERY_CHOOSE'
 
 
-def get_answer_by_customer_coords(customer_coords):
-    nearest_pizzeria = utils.get_nearest_pizzeria(customer_coords)
+async def get_answer_by_customer_coords(customer_coords, index):
+    nearest_pizzeria, delivery_tier = await delivery_zones.async_find_serving_pizzeria(customer_coords, index)
     customer_is_close = True
     delivery_price = 0
-    if nearest_pizzeria['distance'] <= 0.5:
+    if delivery_tier == 0:
         meters_distance = round(nearest_pizzeria['distance'] * 100)
         answer = dedent(f'''\
             Может заберете пиццу из нашей пиццерии неподолёку? Она всего в {meters_distance} метров от Вас. Вот её адресс:
             {nearest_pizzeria['address']}\n
             А можем и бесплатно доставить, нам не сложно :)
         ''')
-    elif nearest_pizzeria['distance'] <= 5:
-        answer = 'Похоже придется ехать до вас на самокате. Доставка будет стоить 100 рублей. Доставляем или самовывоз?'
-        delivery_price = 100
-    elif nearest_pizzeria['distance'] <= 20:
-        answer = 'Довольно далеко до ближайшей пиццерии. Доставка будет стоить 300 рублей.'
-        delivery_price = 300
+    elif delivery_tier == 1:
+        delivery_price = delivery_zones.DELIVERY_TIERS[delivery_tier][1]
+        answer = f'Похоже придется ехать до вас на самокате. Доставка будет стоить {delivery_price} рублей. Доставляем или самовывоз?'
+    elif delivery_tier == 2:
+        delivery_price = delivery_zones.DELIVERY_TIERS[delivery_tier][1]
+        answer = f'Довольно далеко до ближайшей пиццерии. Доставка будет стоить {delivery_price} рублей.'
     else:
         answer = dedent(f'''
         Простите, но так далеко мы пиццу не доставим. Ближайшая пиццерия в {round(nearest_pizzeria['distance'], 1)} км от вас!
@@ -325,20 +435,21 @@ async def handle_delivery_choose(callback_query: types.CallbackQuery):
     delivery_price = 0
     if 'pickup' in callback_query.data:
         pizzeria_id = callback_query.data.split(',')[1]
-        pizzeria_address = moltin_aps.get_entry('pizzeria', pizzeria_id)['address']
+        pizzeria_address = (await moltin_aioaps.get_entry('pizzeria', pizzeria_id))['address']
         text = f'Мы начали готовить вашу пиццу. Ждём вас в нашей пиццерии по адресу:\n{pizzeria_address}'
         callback_answer = 'Ждём вас в пиццерии'
     elif 'delivery' in callback_query.data:
         coords_id, delivery_price = callback_query.data.split(',')[1:3]
-        coords = moltin_aps.get_entry('customer-address', coords_id)
+        coords = await moltin_aioaps.get_entry('customer-address', coords_id)
         coords = (coords['latitude'], coords['longitude'])
-        pizzeria_id = utils.get_nearest_pizzeria(coords)['id']
-        deliveryman_id = moltin_aps.get_entry('pizzeria', pizzeria_id)['deliveryman-tg-id']
+        index = await pizzeria_index.async_get_index()
+        pizzeria_id = (await delivery_zones.async_find_serving_pizzeria(coords, index))[0]['id']
+        deliveryman_id = (await moltin_aioaps.get_entry('pizzeria', pizzeria_id))['deliveryman-tg-id']
         customer_cart_name = f'tg-{callback_query.message.chat.id}'
         await notify_deliveryman(deliveryman_id, customer_cart_name, delivery_price, coords[0], coords[1])
         text = 'Курьер доставит пиццу в течение 60 минут'
         callback_answer = 'Скоро пицца приедет к вам'
-        dp.loop.create_task(notify_delivery_timeout(callback_query.message.chat.id))
+        asyncio.get_event_loop().create_task(notify_delivery_timeout(callback_query.message.chat.id))
 
     payment_keyboard = InlineKeyboardMarkup().add(InlineKeyboardButton('Оплатить', callback_data=f'payment,{delivery_price}'))
     await bot.send_message(callback_query.message.chat.id, text)
@@ -350,14 +461,14 @@ async def handle_delivery_choose(callback_query: types.CallbackQuery):
 
 
 async def notify_deliveryman(deliveryman_id, customer_cart_name, delivery_price, lat, lon):
-    cart_items = moltin_aps.get_cart_items(customer_cart_name)
+    cart_items = await moltin_aioaps.get_cart_items(customer_cart_name)
     text = f'Заказ от {customer_cart_name}:\n'
     for item in cart_items:
         text += dedent(f'''\
             {item['name']}
             {item['quantity']} шт. в корзине на сумму {item['meta']['display_price']['with_tax']['value']['formatted']}\n
         ''')
-    cart_price = moltin_aps.get_cart(customer_cart_name)['meta']['display_price']['with_tax']['amount']
+    cart_price = (await moltin_aioaps.get_cart(customer_cart_name))['meta']['display_price']['with_tax']['amount']
     total_price = int(cart_price) + int(delivery_price)
     text += f'Всего: {total_price} ₽'
     await delivery_bot.send_message(deliveryman_id, text)
@@ -365,7 +476,7 @@ async def notify_deliveryman(deliveryman_id, customer_cart_name, delivery_price,
 
 
 async def notify_delivery_timeout(user_id):
-    await sleep(300)
+    await asyncio.sleep(300)
     # TODO check if order already delivered
     text = dedent('''\
         Время доставки подошло к концу. Мы вернем вам деньги за ваш заказ.
@@ -377,7 +488,7 @@ async def notify_delivery_timeout(user_id):
 
 async def handle_payment(callback_query: types.CallbackQuery):
     user_id = callback_query.message.chat.id
-    goods_price = moltin_aps.get_cart(f'tg-{user_id}')['meta']['display_price']['with_tax']['amount']
+    goods_price = (await moltin_aioaps.get_cart(f'tg-{user_id}'))['meta']['display_price']['with_tax']['amount']
     delivery_price = callback_query.data.split(',')[1]
     total_price = goods_price + int(delivery_price)
     date = int(callback_query.message.date.timestamp())
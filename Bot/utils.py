@@ -1,13 +1,94 @@
-from geopy.distance import distance
-import requests
+from collections import OrderedDict
+import json
+import logging
+import os
+import re
+import threading
 
-import moltin_aps
+import db_aps
+import http_sessions
+
+
+geo_logger = logging.getLogger('geo_logger')
+
+GEOCODE_CACHE_TTL = int(os.getenv('GEOCODE_CACHE_TTL', 30 * 24 * 60 * 60))
+GEOCODE_NOT_FOUND_TTL = int(os.getenv('GEOCODE_NOT_FOUND_TTL', 60 * 60))
+GEOCODE_LOCAL_CACHE_SIZE = int(os.getenv('GEOCODE_LOCAL_CACHE_SIZE', 4096))
+
+_geocoded_places = OrderedDict()
+_geocoded_places_lock = threading.Lock()
+_local_geocoder_places = None
 
 
 def fetch_coordinates(apikey, place):
+    normalized_place = normalize_address(place)
+    with _geocoded_places_lock:
+        coords = _geocoded_places.get(normalized_place)
+        if coords is not None:
+            _geocoded_places.move_to_end(normalized_place)
+            return coords
+
+    db = db_aps.get_database_connection()
+    cache_key = f'geocode:{normalized_place}'
+    cached_coords = db.get(cache_key)
+    if cached_coords is not None:
+        coords = parse_cached_coordinates(cached_coords.decode('utf-8'))
+    else:
+        coords = geocode(apikey, place)
+        if coords[0] is None:
+            db.set(cache_key, '', ex=GEOCODE_NOT_FOUND_TTL)
+        else:
+            db.set(cache_key, '{},{}'.format(*coords), ex=GEOCODE_CACHE_TTL)
+        geo_logger.debug(f'Address «{normalized_place}» was geocoded')
+
+    if coords[0] is not None:
+        with _geocoded_places_lock:
+            _geocoded_places[normalized_place] = coords
+            if len(_geocoded_places) > GEOCODE_LOCAL_CACHE_SIZE:
+                _geocoded_places.popitem(last=False)
+    return coords
+
+
+def normalize_address(place):
+    words = re.findall(r'\w+', place.lower().replace('ё', 'е'))
+    return ' '.join(words)
+
+
+def parse_cached_coordinates(cached_coords):
+    if not cached_coords:
+        return None, None
+    lat, lon = cached_coords.split(',')
+    return float(lat), float(lon)
+
+
+def geocode(apikey, place):
+    if os.getenv('GEOCODER_BACKEND') == 'local':
+        return geocode_locally(place)
+    return geocode_with_yandex(apikey, place)
+
+
+def geocode_locally(place):
+    '''
+    Stand-in geocoder for tests and development. Reads addresses from json file
+    GEOCODER_LOCAL_FILE: {"address": [lat, lon], ...}
+    '''
+    global _local_geocoder_places
+    if _local_geocoder_places is None:
+        with open(os.environ['GEOCODER_LOCAL_FILE'], encoding='utf-8') as places_file:
+            places = json.load(places_file)
+        _local_geocoder_places = {normalize_address(address): coords for address, coords in places.items()}
+    coords = _local_geocoder_places.get(normalize_address(place))
+    if not coords:
+        return None, None
+    lat, lon = coords
+    return float(lat), float(lon)
+
+
+def geocode_with_yandex(apikey, place):
     base_url = 'https://geocode-maps.yandex.ru/1.x'
     params = {'geocode': place, 'apikey': apikey, 'format': 'json'}
-    response = requests.get(base_url, params=params)
+    session = http_sessions.get_session('geocode-maps.yandex.ru')
+    response = session.get(base_url, params=params, timeout=http_sessions.TIMEOUT)
     response.raise_for_status()
     places_found = response.json()['response']['GeoObjectCollection']['featureMember']
     if not places_found:
@@ -15,16 +96,3 @@ def fetch_coordinates(apikey, place):
     most_relevant = places_found[0]
     lon, lat = most_relevant['GeoObject']['Point']['pos'].split(' ')
     return float(lat), float(lon)
-
-
-def get_nearest_pizzeria(customer_coords):
-    pizzerias = moltin_aps.get_all_entries('pizzeria')
-    for pizzeria in pizzerias:
-        pizzeria_coords = (pizzeria['latitude'], pizzeria['longitude'])
-        pizzeria['distance'] = distance(customer_coords, pizzeria_coords).kilometers
-    nearest_pizzeria = min(pizzerias, key=get_pizzeria_distance)
-    return nearest_pizzeria
-
-
-def get_pizzeria_distance(pizzeria):
-    return pizzeria['distance']
@@ -0,0 +1,52 @@
+import pytest
+
+import cart_mirror
+import db_aps
+
+
+# the compare-and-set is a Lua script, so it is checked against a redis emulator with Lua support
+fakeredis = pytest.importorskip('fakeredis')
+pytest.importorskip('lupa')
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(db_aps, 'get_database_connection', lambda: db)
+    return db
+
+
+def make_items_response(quantity):
+    return {
+        'data': [{'id': 'item', 'quantity': quantity}],
+        'meta': {'display_price': {'with_tax': {'amount': 500 * quantity}}},
+    }
+
+
+def test_fetched_cart_is_saved_when_there_is_no_mirror(db):
+    mirror = cart_mirror.save_cart_mirror_if_unchanged('tg-1', make_items_response(1))
+
+    assert cart_mirror.get_cart_mirror('tg-1') == mirror
+    assert 0 < db.ttl('cart:tg-1') <= cart_mirror.CART_MIRROR_TTL
+
+
+def test_fetched_cart_replaces_mirror_it_was_fetched_after(db):
+    old_mirror = cart_mirror.save_cart_mirror('tg-1', make_items_response(1))
+    mirror = cart_mirror.save_cart_mirror_if_unchanged('tg-1', make_items_response(2), old_mirror['synced_at'])
+
+    assert mirror['items'][0]['quantity'] == 2
+    assert cart_mirror.get_cart_mirror('tg-1') == mirror
+
+
+def test_slow_fetch_does_not_overwrite_newer_mirror(db):
+    old_mirror = cart_mirror.save_cart_mirror('tg-1', make_items_response(1))
+    # item added while the cart was fetched
+    newer_mirror = cart_mirror.save_cart_mirror('tg-1', make_items_response(3))
+    mirror = cart_mirror.save_cart_mirror_if_unchanged('tg-1', make_items_response(1), old_mirror['synced_at'])
+
+    assert mirror == newer_mirror
+    assert cart_mirror.get_cart_mirror('tg-1') == newer_mirror
+
+    # mirror appeared while a cart without mirror was fetched
+    mirror = cart_mirror.save_cart_mirror_if_unchanged('tg-1', make_items_response(1))
+    assert mirror == newer_mirror
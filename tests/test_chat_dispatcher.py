@@ -0,0 +1,100 @@
+import asyncio
+
+from aiogram import types
+import pytest
+
+import chat_dispatcher
+import db_aps
+
+
+class FakeAsyncDb:
+    '''
+    Runs CHECK_CALLBACK_SCRIPT semantics in memory.
+    '''
+
+    def __init__(self):
+        self.values = {}
+
+    async def eval(self, script, keys=[], args=[]):
+        assert script == chat_dispatcher.CHECK_CALLBACK_SCRIPT
+        last_message_id = self.values.get(keys[0])
+        if last_message_id is not None and args[0] < last_message_id:
+            return 1
+        self.values[keys[0]] = args[0]
+        return 0
+
+
+@pytest.fixture
+def locks(monkeypatch):
+    db = FakeAsyncDb()
+    locks = {'held': set(), 'acquired': []}
+
+    async def get_async_database_connection():
+        return db
+
+    async def async_acquire_lock(lock_key, timeout, blocking=True):
+        assert lock_key not in locks['held']
+        locks['held'].add(lock_key)
+        locks['acquired'].append(lock_key)
+        return 'token'
+
+    async def async_release_lock(lock_key, token):
+        locks['held'].remove(lock_key)
+
+    monkeypatch.setattr(db_aps, 'get_async_database_connection', get_async_database_connection)
+    monkeypatch.setattr(db_aps, 'async_acquire_lock', async_acquire_lock)
+    monkeypatch.setattr(db_aps, 'async_release_lock', async_release_lock)
+    monkeypatch.setattr(chat_dispatcher, '_active_chats', None)
+    return locks
+
+
+def make_message(chat_id, message_id):
+    return types.Message(message_id=message_id, chat=types.Chat(id=chat_id, type='private'), text='menu')
+
+
+def make_callback(chat_id, message_id):
+    return types.CallbackQuery(id=f'{chat_id}:{message_id}', data='menu', message=make_message(chat_id, message_id))
+
+
+async def dispatch_all(updates, handler):
+    for chat_id, update in updates:
+        await chat_dispatcher.dispatch(chat_id, update, handler)
+    while chat_dispatcher._chat_queues:
+        await asyncio.sleep(0.01)
+
+
+def test_chat_updates_are_handled_in_order(locks):
+    handled = []
+
+    async def handler(update):
+        # the first update of each chat is the slowest one
+        await asyncio.sleep(0.05 if update.message_id == 1 else 0.01)
+        handled.append((update.chat.id, update.message_id))
+
+    updates = [(f'tg-{chat_id}', make_message(chat_id, message_id)) for message_id in (1, 2, 3) for chat_id in (1, 2)]
+    asyncio.run(dispatch_all(updates, handler))
+
+    assert [message_id for chat_id, message_id in handled if chat_id == 1] == [1, 2, 3]
+    assert [message_id for chat_id, message_id in handled if chat_id == 2] == [1, 2, 3]
+    # chats don't wait for each other
+    assert handled[:2] in ([(1, 1), (2, 1)], [(2, 1), (1, 1)])
+    assert sorted(locks['acquired']) == ['chat_lock:tg-1', 'chat_lock:tg-2']
+    assert locks['held'] == set()
+
+
+def test_callback_from_older_message_is_dropped(locks, monkeypatch):
+    handled = []
+    answered = []
+
+    async def handler(update):
+        handled.append(update.message.message_id)
+
+    async def answer(callback_query, *args, **kwargs):
+        answered.append(callback_query.message.message_id)
+
+    monkeypatch.setattr(types.CallbackQuery, 'answer', answer)
+    updates = [('tg-1', make_callback(1, message_id)) for message_id in (10, 7, 10, 12)]
+    asyncio.run(dispatch_all(updates, handler))
+
+    assert handled == [10, 10, 12]
+    assert answered == [7]
@@ -0,0 +1,33 @@
+import random
+
+from geopy.distance import distance
+
+import delivery_zones
+import pizzeria_index
+
+
+def test_zone_map_answers_match_exact_geodesic_search():
+    rng = random.Random(1)
+    pizzerias = [
+        {'id': f'pizzeria_{number}', 'latitude': rng.uniform(55.6, 55.9), 'longitude': rng.uniform(37.4, 37.8)}
+        for number in range(30)
+    ]
+    index = pizzeria_index.PizzeriaIndex(pizzerias, version=1)
+    zones = delivery_zones.build_zone_map(index)
+
+    zone_answers = 0
+    for _ in range(3000):
+        coords = (rng.uniform(55.4, 56.1), rng.uniform(37.1, 38.1))
+        pizzeria, tier = delivery_zones.find_pizzeria_in_zones(coords, index, zones)
+        distances = [
+            distance(coords, (candidate['latitude'], candidate['longitude'])).kilometers
+            for candidate in pizzerias
+        ]
+        nearest_distance = min(distances)
+        assert pizzeria['id'] == pizzerias[distances.index(nearest_distance)]['id']
+        assert abs(pizzeria['distance'] - nearest_distance) < 1e-9
+        assert tier == delivery_zones.get_delivery_tier(nearest_distance)
+        if '{}:{}'.format(*delivery_zones.get_cell(coords)) in zones:
+            zone_answers += 1
+    # points farther than the last tier are outside the map, points near pizzerias must be answered by it
+    assert zone_answers > 1000
@@ -0,0 +1,67 @@
+import pytest
+
+import db_aps
+import utils
+
+
+class FakeDb:
+
+    def __init__(self):
+        self.values = {}
+        self.ttls = {}
+
+    def get(self, key):
+        value = self.values.get(key)
+        return value.encode('utf-8') if value is not None else None
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+        self.ttls[key] = ex
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = FakeDb()
+    monkeypatch.setattr(db_aps, 'get_database_connection', lambda: db)
+    utils._geocoded_places.clear()
+    yield db
+    utils._geocoded_places.clear()
+
+
+@pytest.fixture
+def geocoded_places(monkeypatch):
+    geocoded_places = []
+
+    def geocode(apikey, place):
+        geocoded_places.append(place)
+        if 'нигде' in place.lower():
+            return None, None
+        return 55.75, 37.62
+
+    monkeypatch.setattr(utils, 'geocode', geocode)
+    return geocoded_places
+
+
+def test_address_normalization():
+    assert utils.normalize_address('  Москва,   ул. Тверская, д.1 ') == 'москва ул тверская д 1'
+    assert utils.normalize_address('Мясницкая, Ёлки') == utils.normalize_address('мясницкая елки')
+
+
+def test_repeated_address_is_not_geocoded_again(db, geocoded_places):
+    assert utils.fetch_coordinates('key', 'Москва, Тверская 1') == (55.75, 37.62)
+    assert utils.fetch_coordinates('key', 'москва тверская,  1') == (55.75, 37.62)
+    assert geocoded_places == ['Москва, Тверская 1']
+    assert db.ttls['geocode:москва тверская 1'] == utils.GEOCODE_CACHE_TTL
+
+    # another process: coordinates come from db, not from the geocoder
+    utils._geocoded_places.clear()
+    assert utils.fetch_coordinates('key', 'Москва, Тверская 1') == (55.75, 37.62)
+    assert geocoded_places == ['Москва, Тверская 1']
+
+
+def test_not_found_address_is_cached_with_short_ttl(db, geocoded_places):
+    assert utils.fetch_coordinates('key', 'Нигде, 1') == (None, None)
+    assert utils.fetch_coordinates('key', 'нигде 1') == (None, None)
+    assert geocoded_places == ['Нигде, 1']
+    assert db.values['geocode:нигде 1'] == ''
+    assert db.ttls['geocode:нигде 1'] == utils.GEOCODE_NOT_FOUND_TTL
@@ -0,0 +1,88 @@
+import asyncio
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import types
+
+import pytest
+import requests
+
+import moltin_aiorequests
+import moltin_requests
+import moltin_token
+
+
+PAGE = {'data': [{'id': 'pizza'}]}
+ETAG = '"catalog-1"'
+
+
+class MoltinStandInHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.conditional_headers.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.send_header('ETag', ETAG)
+            self.end_headers()
+            return
+        body = json.dumps(PAGE).encode('utf-8')
+        self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def moltin_url(monkeypatch):
+    monkeypatch.setattr(moltin_token, 'get_access_token', lambda: 'token')
+    monkeypatch.setattr(moltin_token, 'get_cached_access_token', lambda: 'token')
+    moltin_requests._etag_pages.clear()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MoltinStandInHandler)
+    server.conditional_headers = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server, f'http://127.0.0.1:{server.server_port}/v2/products'
+    server.shutdown()
+    server.server_close()
+
+
+def test_sync_get_reuses_page_on_not_modified(moltin_url, monkeypatch):
+    server, url = moltin_url
+    first_page = moltin_requests.get_page(url)
+
+    def fail_parsing(response):
+        raise AssertionError('Not modified page must not be parsed')
+
+    monkeypatch.setattr(requests.Response, 'json', fail_parsing)
+    second_page = moltin_requests.get_page(url)
+
+    assert first_page == PAGE
+    assert second_page is first_page
+    assert server.conditional_headers == [None, ETAG]
+
+
+def test_async_get_reuses_page_on_not_modified(moltin_url, monkeypatch):
+    server, url = moltin_url
+
+    async def get_pages():
+        try:
+            first_page = await moltin_aiorequests.get_page(url, {'page[limit]': 1})
+
+            def fail_parsing(content):
+                raise AssertionError('Not modified page must not be parsed')
+
+            monkeypatch.setattr(moltin_aiorequests, 'json', types.SimpleNamespace(loads=fail_parsing))
+            second_page = await moltin_aiorequests.get_page(url, {'page[limit]': 1})
+        finally:
+            await moltin_aiorequests.close_session()
+        return first_page, second_page
+
+    first_page, second_page = asyncio.run(get_pages())
+
+    assert first_page == PAGE
+    assert second_page is first_page
+    assert server.conditional_headers == [None, ETAG]
@@ -0,0 +1,86 @@
+import asyncio
+import threading
+
+import pytest
+
+import moltin_limiter
+
+
+def test_checkout_requests_go_before_browsing():
+    assert moltin_limiter.get_request_priority('https://api.moltin.com/v2/carts/1/items') == 0
+    assert moltin_limiter.get_request_priority('flows/pizzeria/entries') == 0
+    assert moltin_limiter.get_request_priority('products') == 1
+
+
+def test_window_halves_on_overload_and_grows_back():
+    limiter = moltin_limiter.ThreadRequestLimiter(rate=100, burst=10, max_concurrency=8)
+    limiter.acquire(1)
+    limiter.release(429, retry_after=0)
+    assert limiter.window == 4
+    limiter.acquire(1)
+    limiter.release(200)
+    assert 4 < limiter.window < 5
+
+
+def test_cancelled_async_waiter_does_not_block_next_requests():
+    limiter = moltin_limiter.AsyncRequestLimiter(rate=100, burst=10, max_concurrency=1)
+
+    async def check():
+        await limiter.acquire(1)
+        waiter = asyncio.ensure_future(limiter.acquire(0))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        await limiter.release(200)
+        await asyncio.wait_for(limiter.acquire(1), 1)
+        await limiter.release(200)
+        assert limiter.waiters == []
+        assert limiter.in_flight == 0
+
+    asyncio.run(check())
+
+
+def test_async_waiter_wakes_up_when_token_is_refilled():
+    limiter = moltin_limiter.AsyncRequestLimiter(rate=50, burst=1, max_concurrency=4)
+
+    async def check():
+        await limiter.acquire(1)
+        await asyncio.wait_for(limiter.acquire(1), 1)
+        assert limiter.in_flight == 2
+
+    asyncio.run(check())
+
+
+def test_failed_thread_waiter_does_not_block_next_requests():
+    limiter = moltin_limiter.ThreadRequestLimiter(rate=100, burst=10, max_concurrency=1)
+    limiter.acquire(1)
+    original_wait = limiter.condition.wait
+
+    def interrupted_wait(timeout=None):
+        raise KeyboardInterrupt
+
+    limiter.condition.wait = interrupted_wait
+    with pytest.raises(KeyboardInterrupt):
+        limiter.acquire(0)
+    limiter.condition.wait = original_wait
+    limiter.release(200)
+
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: limiter.acquire(1) or acquired.set())
+    thread.start()
+    thread.join(1)
+    assert acquired.is_set()
+    assert limiter.waiters == []
+
+
+def test_server_errors_without_retry_after_back_off_with_jitter():
+    assert moltin_limiter.get_retry_after(200, {}) is None
+    assert moltin_limiter.get_retry_after(404, {}) is None
+    assert moltin_limiter.get_retry_after(429, {'Retry-After': '7'}) == 7
+    for attempt in range(3):
+        delays = {moltin_limiter.get_retry_after(502, {}, attempt) for _ in range(20)}
+        max_delay = moltin_limiter.DEFAULT_RETRY_AFTER * 2 ** attempt
+        assert all(max_delay / 2 <= delay <= max_delay for delay in delays)
+        assert len(delays) > 1
+    assert moltin_limiter.get_retry_after(500, {}, 100) <= moltin_limiter.MAX_RETRY_AFTER
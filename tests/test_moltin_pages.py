@@ -0,0 +1,90 @@
+import asyncio
+import threading
+import time
+
+import moltin_aiorequests
+import moltin_requests
+
+
+def collect_pages(page_urls):
+    '''
+    Fake moltin pages chained by `links.next`.
+    '''
+    pages = {}
+    for number, url in enumerate(page_urls):
+        next_url = page_urls[number + 1] if number + 1 < len(page_urls) else None
+        pages[url] = {
+            'data': [{'id': url}],
+            'links': {'current': url, 'next': next_url},
+        }
+    return pages
+
+
+def test_concurrent_iterations_share_page_requests(monkeypatch):
+    first_url = 'https://api.moltin.com/v2/products'
+    pages = collect_pages([first_url, f'{first_url}?page[offset]=1'])
+    requested_urls = []
+
+    def get_page(url, payload=None):
+        requested_urls.append(url)
+        time.sleep(0.1)
+        return pages[url]
+
+    monkeypatch.setattr(moltin_requests, 'get_page', get_page)
+    results = []
+
+    def iterate_pages():
+        results.append(list(moltin_requests.iterate_pages('products', page_limit=1)))
+
+    threads = [threading.Thread(target=iterate_pages) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [list(pages.values())] * 3
+    assert requested_urls == list(pages)
+
+
+def test_async_concurrent_iterations_share_page_requests(monkeypatch):
+    first_url = 'https://api.moltin.com/v2/products'
+    pages = collect_pages([first_url, f'{first_url}?page[offset]=1'])
+    requested_urls = []
+
+    async def get_page(url, payload=None):
+        requested_urls.append(url)
+        await asyncio.sleep(0.1)
+        return pages[url]
+
+    async def iterate_pages():
+        return [page async for page in moltin_aiorequests.iterate_pages('products', page_limit=1)]
+
+    async def iterate_concurrently():
+        return await asyncio.gather(*[iterate_pages() for _ in range(3)])
+
+    monkeypatch.setattr(moltin_aiorequests, 'get_page', get_page)
+    results = asyncio.run(iterate_concurrently())
+
+    assert results == [list(pages.values())] * 3
+    assert requested_urls == list(pages)
+
+
+def test_short_pages_do_not_stop_iteration(monkeypatch):
+    first_url = 'https://api.moltin.com/v2/products'
+    pages = collect_pages([first_url, f'{first_url}?page[offset]=100'])
+    monkeypatch.setattr(moltin_requests, 'get_page', lambda url, payload=None: pages[url])
+
+    assert list(moltin_requests.iterate_pages('products', page_limit=500)) == list(pages.values())
+
+
+def test_last_page_by_meta_stops_iteration():
+    page = {
+        'data': [],
+        'links': {'current': 'current', 'next': 'next'},
+        'meta': {'page': {'current': 2, 'total': 2}},
+    }
+    assert moltin_requests.get_next_page_url(page) is None
+    page['meta']['page']['current'] = 1
+    assert moltin_requests.get_next_page_url(page) == 'next'
+    page['links']['next'] = 'current'
+    assert moltin_requests.get_next_page_url(page) is None
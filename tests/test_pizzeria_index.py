@@ -0,0 +1,15 @@
+from geopy.distance import distance
+
+import pizzeria_index
+
+
+def test_haversine_error_bounds_geodesic_distance():
+    for lat in range(-88, 90, 8):
+        for lat_shift, lon_shift in [(0.05, 0), (0, 0.05), (0.03, 0.03), (1, 0), (0, 1)]:
+            coords = (lat, 10)
+            pizzeria_coords = (lat + lat_shift, 10 + lon_shift)
+            pizzeria = {'id': 'pizzeria', 'latitude': pizzeria_coords[0], 'longitude': pizzeria_coords[1]}
+            index = pizzeria_index.PizzeriaIndex([pizzeria])
+            haversine_distance = index.get_haversine_distances(coords)[0]
+            geodesic_distance = distance(coords, pizzeria_coords).kilometers
+            assert abs(haversine_distance / geodesic_distance - 1) <= pizzeria_index.HAVERSINE_ERROR